@@ -0,0 +1,170 @@
+"""
+Response caching for the Claude analysis calls.
+
+disk_cache / cached_call is an exact-match cache keyed by
+sha256(prompt version | participant | transcript), stored in a single SQLite
+file under .cache/claude/ (or $PSYCHOGRAPH_CACHE_DIR/claude/). Re-running the
+same export costs nothing.
+
+The stored responses are clinical analyses that quote the patient's messages,
+so they are not kept forever: an entry expires DISK_CACHE_TTL_DAYS after it
+was written (PSYCHOGRAPH_CACHE_TTL_DAYS overrides it). Delete the cache
+directory to remove everything at once.
+
+Only an identical transcript is ever served from the cache: two threads that
+merely look alike ("i am fine thanks" / "i want to kill myself") can call for
+opposite clinical readings, so there is no similarity matching.
+
+Bump PROMPT_VERSION[kind] whenever a prompt template changes so stale
+responses for that kind are no longer served.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+# ── Bump a kind's version whenever its prompt template changes ──
+PROMPT_VERSION = {
+    "all":  1,
+    "dsm5": 3,
+}
+
+# ── Where cached responses live (default: relative to the working directory) ──
+CACHE_DIR = os.environ.get("PSYCHOGRAPH_CACHE_DIR", ".cache")
+DISK_CACHE_PATH = os.path.join(CACHE_DIR, "claude", "responses.sqlite3")
+
+# ── Oldest-accessed entries are evicted beyond this many responses ──
+DISK_CACHE_MAX_ENTRIES = 20_000
+
+# ── Responses are deleted this many days after they were written ──
+DISK_CACHE_TTL_DAYS = float(os.environ.get("PSYCHOGRAPH_CACHE_TTL_DAYS", "7"))
+
+
+# ════════════════════════════════════════════════════════════════
+#  EXACT-MATCH DISK CACHE
+# ════════════════════════════════════════════════════════════════
+
+class DiskCache:
+    """
+    Thread-safe, size-bounded key -> JSON store in one SQLite file.
+    Least-recently-used entries are evicted past max_entries, and every entry
+    is deleted ttl_days after it was written.
+    """
+
+    def __init__(self, path: str = DISK_CACHE_PATH, max_entries: int = DISK_CACHE_MAX_ENTRIES,
+                 ttl_days: float = DISK_CACHE_TTL_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        """Open (and create if needed) the SQLite file on first use, dropping expired entries."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, kind TEXT, response TEXT, accessed REAL, created REAL)"
+        )
+        # Files written before entries expired have no created column; date
+        # their entries from the last access
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(responses)")]
+        if "created" not in columns:
+            self._conn.execute("ALTER TABLE responses ADD COLUMN created REAL")
+            self._conn.execute("UPDATE responses SET created = accessed")
+        self._expire()
+        self._conn.commit()
+
+    def _expire(self):
+        """Delete entries older than the TTL (caller holds the lock and commits)."""
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_seconds,))
+
+    def get(self, key: str):
+        """Return the stored response for key, or None (also once it has expired)."""
+        with self._lock:
+            if self._conn is None:
+                self._connect()
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?",
+                (key, time.time() - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, kind: str, response: dict):
+        """Store a response, then drop expired entries and the least recently used overflow."""
+        with self._lock:
+            if self._conn is None:
+                self._connect()
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, kind, response, accessed, created) VALUES (?, ?, ?, ?, ?)",
+                (key, kind, json.dumps(response, ensure_ascii=False), now, now)
+            )
+            self._expire()
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+
+_disk_cache = DiskCache()
+
+
+def cache_key(kind: str, conversation_text: str, participant: str) -> str:
+    """Stable key for one analysis of one conversation under the current prompt version."""
+    raw = f"{kind}:{PROMPT_VERSION.get(kind, 0)}|{participant}|{conversation_text}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def cached_call(kind: str, conversation_text: str, participant: str, fn, refresh: bool = False,
+                cacheable=None) -> dict:
+    """
+    Return fn(conversation_text, participant), served from the disk cache
+    when this exact analysis has been run before. Falls through to the
+    live call on a miss (or if the cache file can't be used).
+    With refresh=True the stored response is ignored and overwritten.
+    If given, cacheable(response) decides whether a fresh response is stored,
+    so a degraded one is retried next time instead of being served forever.
+    """
+    key = cache_key(kind, conversation_text, participant)
+    cached = None
+    if not refresh:
+        try:
+            cached = _disk_cache.get(key)
+        except sqlite3.Error:
+            pass  # a broken cache must never block the analysis
+    if cached is not None:
+        return cached
+
+    response = fn(conversation_text, participant)
+    if cacheable is not None and not cacheable(response):
+        return response
+    try:
+        _disk_cache.set(key, kind, response)
+    except sqlite3.Error:
+        pass
+    return response
+
+
+def disk_cache(kind: str, cacheable=None):
+    """Decorator form of cached_call for fn(conversation_text, participant) -> dict."""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(conversation_text: str, participant: str, refresh: bool = False) -> dict:
+            return cached_call(kind, conversation_text, participant, fn, refresh, cacheable)
+
+        return wrapper
+
+    return decorator
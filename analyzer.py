@@ -12,24 +12,60 @@ Inside that folder, messages are split across subfolders like:
 This script handles all of that automatically.
 """
 
+import copy
+import functools
+import hashlib
+import importlib.util
 import json
 import os
 import re
-import glob
+import threading
+import time
 from collections import defaultdict
-from anthropic import Anthropic
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# ── Import DSM-5 diagnostic module ──────────────────────────────────────────
+from analysis_cache import disk_cache
+from claude_utils import keep_recent_lines
+from claude_utils import anthropic_client as _client  # one client (and connection pool) for every call
+
+# ── orjson parses large exports several times faster; stdlib json is the fallback ──
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ── ijson lets huge message files be streamed instead of loaded whole; optional ──
 try:
-    from dsm5_diagnostic_ai import get_dsm5_diagnosis_ai as analyze_dsm5_diagnosis
-    DSM5_AVAILABLE = True
-    print("✓ DSM-5 diagnostic module loaded")
+    import ijson
 except ImportError:
-    DSM5_AVAILABLE = False
+    ijson = None
+
+# ── Check for the DSM-5 diagnostic module without importing it yet ─────────
+# The module (and the Anthropic SDK behind it) is only imported on the first
+# DSM-5 analysis, so importing analyzer just to parse exports stays cheap.
+DSM5_AVAILABLE = importlib.util.find_spec("dsm5_diagnostic_ai") is not None
+if DSM5_AVAILABLE:
+    print("✓ DSM-5 diagnostic module found")
+else:
     print("⚠ Warning: DSM-5 diagnostic module not found. Diagnostic features will be disabled.")
 
-# ── Initialize the Anthropic client (reads ANTHROPIC_API_KEY from environment) ──
-client = Anthropic()
+
+def is_complete_dsm5(result: dict) -> bool:
+    """Whether every selected disorder was assessed; partial screenings are re-run, not cached."""
+    return not result.get("failed_disorders")
+
+
+@disk_cache(kind="dsm5", cacheable=is_complete_dsm5)
+def _analyze_dsm5_diagnosis(conversation_text: str, participant: str) -> dict:
+    """Run the AI DSM-5 screening, importing the diagnostic module on first use."""
+    from dsm5_diagnostic_ai import get_dsm5_diagnosis_ai
+    return get_dsm5_diagnosis_ai(conversation_text, participant)
+
+
+# Bound once here so callers just check for None instead of re-testing DSM5_AVAILABLE
+analyze_dsm5_diagnosis = _analyze_dsm5_diagnosis if DSM5_AVAILABLE else None
+
 
 # ── List of psychological defense mechanisms Claude will look for ──
 DEFENSE_MECHANISMS = [
@@ -38,19 +74,72 @@ DEFENSE_MECHANISMS = [
     "passive aggression", "splitting", "minimization"
 ]
 
+# ── Claude calls are I/O-bound, so many can be in flight at once ──
+MAX_WORKERS = 16
+
+# ── Message files larger than this are streamed with ijson (when installed) ──
+STREAM_THRESHOLD_BYTES = 5 * 1024 * 1024
+
+# ── fix_encoding memoizes messages up to this length; longer ones rarely repeat ──
+FIX_ENCODING_CACHE_MAX_CHARS = 4096
+
+# ── Threads with fewer patient messages than this are too thin to analyze ──
+MIN_PATIENT_MESSAGES = 3
+
+# ── Token budget for one conversation transcript sent to Claude ──
+MAX_CONVERSATION_TOKENS = 6000
+
+# ── Output budget for the combined answer: more than the three separate calls
+# it replaced had between them (1000 + 1000 + 1200), since a cut-off JSON
+# answer loses all three sections at once ──
+ANALYSIS_MAX_TOKENS = 4000
+
+# ── Where results are written (and resumed from) ──
+RESULTS_PATH = "analysis_results.json"
+
+# ── How often to check on a Message Batch while it is processing (seconds) ──
+BATCH_POLL_INTERVAL = 30
+
+# Worker threads share stdout; this keeps their progress lines from interleaving
+_print_lock = threading.Lock()
+
+
+def log(message: str):
+    """Thread-safe print used for progress output from worker threads."""
+    with _print_lock:
+        print(message)
+
 
 # ════════════════════════════════════════════════════════════════
 #  SECTION 1: FILE LOADING
 #  Handles reading Instagram's folder/file export structure
 # ════════════════════════════════════════════════════════════════
 
+def _scan_json_files(path: str):
+    """
+    Walk the folder tree once with os.scandir and yield (filepath, filename)
+    for every .json file. Hidden files and folders are skipped, like glob does.
+    """
+    pending = [path]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif entry.name.endswith(".json") and entry.is_file():
+                    yield entry.path, entry.name
+
+
 def find_message_files(path: str) -> list:
     """
     Given a path that is either:
       - A single message_X.json file
       - A conversation folder (containing message_1.json, message_2.json, etc.)
       - The top-level Instagram export folder
-    Returns a flat list of all message JSON file paths found.
+    Returns a flat, unordered list of all message JSON file paths found;
+    load_instagram_export puts each thread's files in order.
     """
 
     # If it's a single file, just return it directly
@@ -60,32 +149,101 @@ def find_message_files(path: str) -> list:
     # If it's a folder, search recursively for all message_*.json files
     # Instagram names them message_1.json, message_2.json, etc.
     if os.path.isdir(path):
-        pattern = os.path.join(path, "**", "message_*.json")
-        files = glob.glob(pattern, recursive=True)
+        files = []
+        other_json = []  # fallback if the export doesn't use message_*.json names
+        for filepath, name in _scan_json_files(path):
+            if name.startswith("message_"):
+                files.append(filepath)
+            else:
+                other_json.append(filepath)
 
-        if not files:
-            # Fallback: grab any .json files in the folder
-            pattern = os.path.join(path, "**", "*.json")
-            files = glob.glob(pattern, recursive=True)
-
-        return sorted(files)  # sort so message_1 comes before message_2
+        return files or other_json
 
     raise FileNotFoundError(f"Could not find any message files at: {path}")
 
 
+# Instagram's split-file numbering, e.g. ".../message_12.json" -> "12"
+_MESSAGE_FILE_NUMBER = re.compile(r"message_(\d+)\.json$")
+
+
+def message_file_order(filepath: str) -> tuple:
+    """
+    Sort key that orders message_2.json before message_10.json by comparing
+    the number as an integer. Files without the numbered name sort after, by name.
+    """
+    match = _MESSAGE_FILE_NUMBER.search(filepath)
+    if match:
+        return (0, int(match.group(1)), "")
+    return (1, 0, os.path.basename(filepath))
+
+
+def json_loads(data):
+    """Parse JSON from str or bytes with orjson when installed, else the stdlib."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def has_text(msg: dict) -> bool:
+    """True for messages with actual text (not stickers, reactions, media-only, etc.)."""
+    content = msg.get("content")
+    return bool(content) and not content.isspace()
+
+
+def stream_large_file(filepath: str) -> dict:
+    """
+    Stream one very large message file with ijson, keeping only messages that
+    have text. Empty messages are dropped before they are ever materialized,
+    so a 50k-message thread never sits in memory twice.
+    """
+    data = {"participants": [], "messages": []}
+    builder = None
+    item_prefix = None
+
+    with open(filepath, "rb") as f:
+        for prefix, event, value in ijson.parse(f):
+            if builder is not None:
+                builder.event(event, value)
+                # The item's own end_map closes it (nested maps have longer prefixes)
+                if prefix == item_prefix and event == "end_map":
+                    item = builder.value
+                    if item_prefix == "participants.item":
+                        data["participants"].append(item)
+                    elif has_text(item):
+                        data["messages"].append(item)
+                    builder = None
+
+            elif event == "start_map" and prefix in ("participants.item", "messages.item"):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                item_prefix = prefix
+
+            elif prefix == "title" and event == "string":
+                data["title"] = value
+
+    return data
+
+
 def load_single_file(filepath: str) -> dict:
     """
     Load one Instagram message JSON file.
     Instagram sometimes encodes text in latin-1 instead of utf-8,
     so we try utf-8 first, then fall back to latin-1.
     """
+    if ijson is not None and os.path.getsize(filepath) > STREAM_THRESHOLD_BYTES:
+        try:
+            return stream_large_file(filepath)
+        except (ijson.JSONError, UnicodeDecodeError):
+            pass  # not valid utf-8 JSON — use the regular loader's latin-1 fallback
+
+    with open(filepath, "rb") as f:
+        raw = f.read()
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except UnicodeDecodeError:
+        return json_loads(raw)
+    except ValueError:
+        # Invalid utf-8 (UnicodeDecodeError / orjson.JSONDecodeError are both ValueErrors):
         # Instagram occasionally uses latin-1 encoding for older exports
-        with open(filepath, "r", encoding="latin-1") as f:
-            return json.load(f)
+        return json_loads(raw.decode("latin-1"))
 
 
 def load_instagram_export(path: str) -> dict:
@@ -104,16 +262,20 @@ def load_instagram_export(path: str) -> dict:
         folder = os.path.dirname(filepath)
         threads[folder].append(filepath)
 
-    # For each thread folder, merge all message_X.json files together
+    # Read and parse every file concurrently — this is disk-bound, not CPU-bound
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as executor:
+        loaded = dict(zip(files, executor.map(load_single_file, files)))
+
+    # For each thread folder (in a stable order), merge all message_X.json files together
     merged_threads = {}
-    for folder, filepaths in threads.items():
+    for folder, filepaths in sorted(threads.items()):
         thread_name = os.path.basename(folder)  # e.g. "alex_abc123"
         all_messages = []
         participants = []
         title = thread_name
 
-        for fp in sorted(filepaths):  # process in order: message_1, message_2...
-            data = load_single_file(fp)
+        for fp in sorted(filepaths, key=message_file_order):  # message_1, message_2, ... message_10
+            data = loaded[fp]
 
             # Collect participants from first file (they're the same across all split files)
             if not participants and "participants" in data:
@@ -150,15 +312,29 @@ def identify_patient(participants: list) -> str:
     return "Patient"
 
 
+def _repair_mojibake(text: str) -> str:
+    """Undo UTF-8 text that was decoded as latin-1; return it unchanged if it wasn't."""
+    try:
+        return text.encode("latin-1").decode("utf-8")
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        return text  # text was already correct, return as-is
+
+
+# Short messages ("ok 👍", "jajaja 😂") repeat constantly across threads, so memoize them
+_repair_mojibake_cached = functools.lru_cache(maxsize=100_000)(_repair_mojibake)
+
+
 def fix_encoding(text: str) -> str:
     """
     Fix Instagram's common encoding bug where UTF-8 characters get
     double-encoded as latin-1 (e.g., "donâ€™t" should be "don't").
     """
-    try:
-        return text.encode("latin-1").decode("utf-8")
-    except (UnicodeDecodeError, UnicodeEncodeError):
-        return text  # text was already correct, return as-is
+    # Plain ASCII can't contain mojibake and round-trips unchanged — skip the work
+    if text.isascii():
+        return text
+    if len(text) > FIX_ENCODING_CACHE_MAX_CHARS:
+        return _repair_mojibake(text)
+    return _repair_mojibake_cached(text)
 
 
 def parse_thread(thread_data: dict, patient_name: str) -> list:
@@ -166,17 +342,26 @@ def parse_thread(thread_data: dict, patient_name: str) -> list:
     Parse one conversation thread into a clean list of message dicts.
     Filters out empty messages (photos, videos, reactions with no text).
     """
+    return parse_thread_stream(thread_data.get("messages", []), patient_name)
+
+
+def parse_thread_stream(iter_messages, patient_name: str) -> list:
+    """
+    Same as parse_thread, but takes any iterable of raw Instagram message
+    dicts (e.g. a generator streaming them from disk).
+    """
     clean_messages = []
 
-    for msg in thread_data.get("messages", []):
+    for msg in iter_messages:
         content = msg.get("content", "")
-        sender  = msg.get("sender_name", "Unknown")
-        timestamp = msg.get("timestamp_ms", 0)
 
         # Skip empty messages (stickers, reactions, unsent messages, media-only, etc.)
-        if not content or content.strip() == "":
+        if not content or content.isspace():
             continue
 
+        sender    = msg.get("sender_name", "Unknown")
+        timestamp = msg.get("timestamp_ms", 0)
+
         # Fix Instagram's double-encoding bug on the message content
         content = fix_encoding(content)
 
@@ -188,7 +373,7 @@ def parse_thread(thread_data: dict, patient_name: str) -> list:
         })
 
     # Sort chronologically (Instagram exports messages newest-first, we want oldest-first)
-    clean_messages.sort(key=lambda x: x["timestamp"])
+    clean_messages.sort(key=itemgetter("timestamp"))
     return clean_messages
 
 
@@ -204,176 +389,206 @@ def format_for_claude(messages: list) -> str:
     return "\n".join(lines)
 
 
-def trim_to_token_limit(conversation_text: str, max_lines: int = 150) -> str:
+def trim_to_token_limit(conversation_text: str, max_tokens: int = MAX_CONVERSATION_TOKENS) -> str:
     """
-    If a conversation is very long, take only the most recent N messages
-    to avoid exceeding Claude's context window and to keep API costs manageable.
+    If a conversation is very long, keep only the most recent messages that fit
+    in max_tokens. Counting tokens (not lines) means short reactions don't waste
+    the budget and long paragraphs can't blow past the context window or API costs.
+    The newest message is always kept, cut down if it alone is over the budget.
     """
     lines = conversation_text.split("\n")
-    if len(lines) > max_lines:
-        print(f"  (Conversation trimmed from {len(lines)} to last {max_lines} messages)")
-        return "\n".join(lines[-max_lines:])
+    kept = keep_recent_lines(lines, max_tokens)
+
+    if len(kept) < len(lines):
+        print(f"  (Conversation trimmed from {len(lines)} to last {len(kept)} messages, ~{max_tokens} tokens)")
+        return "\n".join(kept)
+    if kept[0] != lines[0]:
+        print(f"  (Conversation's only message cut to ~{max_tokens} tokens)")
+        return kept[0]
     return conversation_text
 
 
 # ════════════════════════════════════════════════════════════════
 #  SECTION 3: CLAUDE ANALYSIS
-#  Three separate prompts: defense mechanisms, KPIs, qualitative summary
+#  One combined prompt: defense mechanisms, KPIs, qualitative summary
 # ════════════════════════════════════════════════════════════════
 
 def clean_json_response(raw: str) -> dict:
     """
-    Claude sometimes wraps JSON in markdown code fences like ```json ... ```
-    This strips those out and parses the clean JSON string.
+    Claude sometimes wraps JSON in markdown code fences like ```json ... ```,
+    or adds a sentence before or after it. Everything from the first "{" to
+    the last "}" is the JSON object, so parse just that.
     """
-    raw = raw.strip()
-    raw = re.sub(r"^```json\s*", "", raw)   # remove opening ```json
-    raw = re.sub(r"^```\s*", "", raw)        # remove opening ``` with no language tag
-    raw = re.sub(r"```$", "", raw)           # remove closing ```
-    return json.loads(raw.strip())
+    start, end = raw.find("{"), raw.rfind("}")
+    if start != -1 and end > start:
+        raw = raw[start:end + 1]
+    return json_loads(raw)
 
 
-def analyze_defense_mechanisms(conversation_text: str, participant: str) -> dict:
+def parse_analysis_response(message) -> dict:
     """
-    Ask Claude to count how many times each defense mechanism appears
-    in BOTH sides of the conversation, with quoted examples.
+    Parse the JSON answer from a combined-prompt response. An answer that ran
+    out of output tokens is reported as such, instead of surfacing as an
+    unexplained JSON syntax error.
     """
-    prompt = f"""You are a clinical psychologist analyzing a conversation between a patient and {participant}.
+    if message.stop_reason == "max_tokens":
+        raise RuntimeError(
+            f"Claude's answer was cut off at max_tokens={ANALYSIS_MAX_TOKENS}, so its JSON is incomplete"
+        )
+    return clean_json_response(message.content[0].text)
+
 
-Conversation:
-{conversation_text}
+# ── Static instruction block ───────────────────────────────────────────────
+# Everything that is identical across conversations lives in the system prompt;
+# only the participant name and transcript go in the user message.
+# The block carries a cache_control marker, but at roughly 1k tokens it is
+# shorter than the minimum prefix Anthropic will cache for this model, so the
+# marker is currently a no-op: every call is billed the full input rate. It
+# only starts to pay off if the instructions grow past that minimum.
+# Defense mechanisms, KPIs and the qualitative summary are requested together,
+# so each transcript is sent (and billed) once instead of three times.
 
-Analyze defense mechanisms in BOTH the PATIENT's and OTHER person's messages. For each person, count occurrences of each defense mechanism and quote one example. Return ONLY valid JSON with no explanation or markdown.
+STATIC_PROMPT_ALL = f"""You are a clinical psychologist analyzing a conversation between a patient and the participant named in the user message.
 
-Defense mechanisms: {', '.join(DEFENSE_MECHANISMS)}
+Analyze BOTH sides of this conversation - the PATIENT's and the OTHER person's messages - and return ONE JSON object with three sections. Return ONLY valid JSON with no explanation or markdown.
+
+1. "defense_mechanisms": for each person, count occurrences of each defense mechanism and quote one example.
+   Defense mechanisms: {', '.join(DEFENSE_MECHANISMS)}
+
+2. "kpis": score each KPI 0-10 for BOTH the patient and the other person with one-sentence rationales.
+
+3. "qualitative_summary": brief case notes on how they each communicate and how they interact.
 
 {{
-  "patient_defense_mechanisms": {{
-    "denial": {{"count": 0, "example": null}},
-    "projection": {{"count": 0, "example": null}},
-    "rationalization": {{"count": 0, "example": null}},
-    "deflection": {{"count": 0, "example": null}},
-    "intellectualization": {{"count": 0, "example": null}},
-    "repression": {{"count": 0, "example": null}},
-    "displacement": {{"count": 0, "example": null}},
-    "passive_aggression": {{"count": 0, "example": null}},
-    "splitting": {{"count": 0, "example": null}},
-    "minimization": {{"count": 0, "example": null}}
+  "defense_mechanisms": {{
+    "patient_defense_mechanisms": {{
+      "denial": {{"count": 0, "example": null}},
+      "projection": {{"count": 0, "example": null}},
+      "rationalization": {{"count": 0, "example": null}},
+      "deflection": {{"count": 0, "example": null}},
+      "intellectualization": {{"count": 0, "example": null}},
+      "repression": {{"count": 0, "example": null}},
+      "displacement": {{"count": 0, "example": null}},
+      "passive_aggression": {{"count": 0, "example": null}},
+      "splitting": {{"count": 0, "example": null}},
+      "minimization": {{"count": 0, "example": null}}
+    }},
+    "other_defense_mechanisms": {{
+      "denial": {{"count": 0, "example": null}},
+      "projection": {{"count": 0, "example": null}},
+      "rationalization": {{"count": 0, "example": null}},
+      "deflection": {{"count": 0, "example": null}},
+      "intellectualization": {{"count": 0, "example": null}},
+      "repression": {{"count": 0, "example": null}},
+      "displacement": {{"count": 0, "example": null}},
+      "passive_aggression": {{"count": 0, "example": null}},
+      "splitting": {{"count": 0, "example": null}},
+      "minimization": {{"count": 0, "example": null}}
+    }},
+    "patient_total": 0,
+    "other_total": 0,
+    "patient_dominant": "none",
+    "other_dominant": "none",
+    "interaction_pattern": "Brief description of how their defense patterns interact"
   }},
-  "other_defense_mechanisms": {{
-    "denial": {{"count": 0, "example": null}},
-    "projection": {{"count": 0, "example": null}},
-    "rationalization": {{"count": 0, "example": null}},
-    "deflection": {{"count": 0, "example": null}},
-    "intellectualization": {{"count": 0, "example": null}},
-    "repression": {{"count": 0, "example": null}},
-    "displacement": {{"count": 0, "example": null}},
-    "passive_aggression": {{"count": 0, "example": null}},
-    "splitting": {{"count": 0, "example": null}},
-    "minimization": {{"count": 0, "example": null}}
+  "kpis": {{
+    "patient_kpis": {{
+      "emotional_openness": {{"score": 0, "rationale": ""}},
+      "vulnerability": {{"score": 0, "rationale": ""}},
+      "conflict_avoidance": {{"score": 0, "rationale": ""}},
+      "empathy_shown": {{"score": 0, "rationale": ""}},
+      "self_awareness": {{"score": 0, "rationale": ""}},
+      "communication_clarity": {{"score": 0, "rationale": ""}},
+      "emotional_reactivity": {{"score": 0, "rationale": ""}}
+    }},
+    "other_kpis": {{
+      "emotional_openness": {{"score": 0, "rationale": ""}},
+      "vulnerability": {{"score": 0, "rationale": ""}},
+      "conflict_avoidance": {{"score": 0, "rationale": ""}},
+      "empathy_shown": {{"score": 0, "rationale": ""}},
+      "self_awareness": {{"score": 0, "rationale": ""}},
+      "communication_clarity": {{"score": 0, "rationale": ""}},
+      "emotional_reactivity": {{"score": 0, "rationale": ""}}
+    }},
+    "patient_overall_score": 0,
+    "other_overall_score": 0,
+    "relationship_health_score": 0,
+    "flag_for_review": false,
+    "flag_reason": null,
+    "dynamic_analysis": "Brief description of how their communication patterns interact"
   }},
-  "patient_total": 0,
-  "other_total": 0,
-  "patient_dominant": "none",
-  "other_dominant": "none",
-  "interaction_pattern": "Brief description of how their defense patterns interact"
+  "qualitative_summary": {{
+    "relationship_dynamic": "Overall dynamic between both people",
+    "patient_patterns": ["Patient's behavioral patterns"],
+    "other_patterns": ["Other person's behavioral patterns"],
+    "interaction_patterns": ["How their patterns interact or conflict"],
+    "patient_red_flags": ["Concerning patterns in patient"],
+    "other_red_flags": ["Concerning patterns in other person"],
+    "patient_strengths": ["Patient's communication strengths"],
+    "other_strengths": ["Other person's communication strengths"],
+    "therapy_suggestions": ["Areas to explore in therapy"],
+    "clinical_notes": "2-3 sentence narrative analyzing the bidirectional dynamic"
+  }}
 }}"""
 
-    # Send the defense mechanism prompt to Claude
-    response = client.messages.create(
-        model="claude-opus-4-5-20251101",
-        max_tokens=1000,
-        messages=[{"role": "user", "content": prompt}]
-    )
 
-    # Strip any markdown formatting and parse the JSON response
-    return clean_json_response(response.content[0].text)
+def build_request(static_prompt: str, conversation_text: str, participant: str, max_tokens: int) -> dict:
+    """
+    Assemble Messages API parameters: the static instructions as the system
+    block, and the per-conversation content as the user message.
+    The system block is marked for prompt caching, which Anthropic ignores
+    while it is below the model's minimum cacheable length.
+    """
+    return {
+        "model": "claude-opus-4-5-20251101",
+        "max_tokens": max_tokens,
+        "system": [{"type": "text", "text": static_prompt, "cache_control": {"type": "ephemeral"}}],
+        "messages": [{
+            "role": "user",
+            "content": f"Participant: {participant}\n\nConversation:\n{conversation_text}"
+        }]
+    }
 
 
-def analyze_kpis(conversation_text: str, participant: str) -> dict:
+def build_analysis_request(conversation_text: str, participant: str) -> dict:
     """
-    Ask Claude to score 7 communication KPIs from 0-10 with rationale for BOTH sides,
-    plus overall scores and flags if concerning patterns exist.
+    Build the Messages API parameters asking Claude for defense mechanism counts,
+    the 7 communication KPIs and the qualitative case notes for BOTH sides,
+    all in one response.
     """
-    prompt = f"""You are a clinical psychologist. Analyze the communication patterns of BOTH people in this conversation.
-
-Conversation:
-{conversation_text}
+    return build_request(STATIC_PROMPT_ALL, conversation_text, participant, max_tokens=ANALYSIS_MAX_TOKENS)
 
-Score each KPI 0-10 for BOTH the patient and the other person with one-sentence rationales. Return ONLY valid JSON, no markdown.
 
-{{
-  "patient_kpis": {{
-    "emotional_openness": {{"score": 0, "rationale": ""}},
-    "vulnerability": {{"score": 0, "rationale": ""}},
-    "conflict_avoidance": {{"score": 0, "rationale": ""}},
-    "empathy_shown": {{"score": 0, "rationale": ""}},
-    "self_awareness": {{"score": 0, "rationale": ""}},
-    "communication_clarity": {{"score": 0, "rationale": ""}},
-    "emotional_reactivity": {{"score": 0, "rationale": ""}}
-  }},
-  "other_kpis": {{
-    "emotional_openness": {{"score": 0, "rationale": ""}},
-    "vulnerability": {{"score": 0, "rationale": ""}},
-    "conflict_avoidance": {{"score": 0, "rationale": ""}},
-    "empathy_shown": {{"score": 0, "rationale": ""}},
-    "self_awareness": {{"score": 0, "rationale": ""}},
-    "communication_clarity": {{"score": 0, "rationale": ""}},
-    "emotional_reactivity": {{"score": 0, "rationale": ""}}
-  }},
-  "patient_overall_score": 0,
-  "other_overall_score": 0,
-  "relationship_health_score": 0,
-  "flag_for_review": false,
-  "flag_reason": null,
-  "dynamic_analysis": "Brief description of how their communication patterns interact"
-}}"""
-
-    # Send the KPI scoring prompt to Claude
-    response = client.messages.create(
-        model="claude-opus-4-5-20251101",
-        max_tokens=1000,
-        messages=[{"role": "user", "content": prompt}]
-    )
+@disk_cache(kind="all")
+def analyze_conversation_all(conversation_text: str, participant: str) -> dict:
+    """
+    Run the combined prompt and return the parsed JSON with
+    "defense_mechanisms", "kpis" and "qualitative_summary" sections.
+    """
+    # One round-trip per conversation for all three analyses
+    response = _client().messages.create(**build_analysis_request(conversation_text, participant))
 
-    # Parse and return the JSON response
-    return clean_json_response(response.content[0].text)
+    # Strip any markdown formatting and parse the JSON response
+    return parse_analysis_response(response)
 
 
-def qualitative_summary(conversation_text: str, participant: str) -> dict:
-    """
-    Ask Claude to write brief clinical case notes about BOTH people's
-    communication styles, patterns, and how they interact.
-    """
-    prompt = f"""You are a clinical psychologist writing brief case notes about a conversation between a patient and {participant}.
+# ── Single-section adapters (kept for callers that want one analysis) ──
+# Each reads its section from analyze_conversation_all; the cache above
+# makes the second and third adapter call for a conversation free.
 
-Conversation:
-{conversation_text}
+def analyze_defense_mechanisms(conversation_text: str, participant: str) -> dict:
+    """Defense mechanism counts and examples for both sides."""
+    return analyze_conversation_all(conversation_text, participant)["defense_mechanisms"]
 
-Analyze BOTH sides of this conversation - how they each communicate and how they interact. Return ONLY valid JSON, no markdown.
 
-{{
-  "relationship_dynamic": "Overall dynamic between both people",
-  "patient_patterns": ["Patient's behavioral patterns"],
-  "other_patterns": ["{participant}'s behavioral patterns"],
-  "interaction_patterns": ["How their patterns interact or conflict"],
-  "patient_red_flags": ["Concerning patterns in patient"],
-  "other_red_flags": ["Concerning patterns in other person"],
-  "patient_strengths": ["Patient's communication strengths"],
-  "other_strengths": ["Other person's communication strengths"],
-  "therapy_suggestions": ["Areas to explore in therapy"],
-  "clinical_notes": "2-3 sentence narrative analyzing the bidirectional dynamic"
-}}"""
+def analyze_kpis(conversation_text: str, participant: str) -> dict:
+    """Communication KPI scores for both sides."""
+    return analyze_conversation_all(conversation_text, participant)["kpis"]
 
-    # Send the qualitative summary prompt to Claude
-    response = client.messages.create(
-        model="claude-opus-4-5-20251101",
-        max_tokens=1200,
-        messages=[{"role": "user", "content": prompt}]
-    )
 
-    # Parse and return the JSON response
-    return clean_json_response(response.content[0].text)
+def qualitative_summary(conversation_text: str, participant: str) -> dict:
+    """Qualitative case notes about both people and how they interact."""
+    return analyze_conversation_all(conversation_text, participant)["qualitative_summary"]
 
 
 # ════════════════════════════════════════════════════════════════
@@ -381,30 +596,126 @@ Analyze BOTH sides of this conversation - how they each communicate and how they
 #  Orchestrates loading → parsing → analysis → saving
 # ════════════════════════════════════════════════════════════════
 
-def run_analysis(path: str) -> dict:
-    """
-    Full pipeline: load all files from the Instagram export path,
-    parse every conversation, run all three Claude analyses on each,
-    and return the compiled results dict.
+def analyze_conversations(conversations: dict, max_workers: int = MAX_WORKERS, on_result=None,
+                          refresh: bool = False, cancel=None) -> dict:
     """
+    Run every Claude analysis for every conversation concurrently.
 
-    # Load and merge all message files from the given path (file or folder)
-    print(f"\nLoading Instagram export from: {path}")
-    threads = load_instagram_export(path)
-    print(f"Found {len(threads)} conversation thread(s)\n")
+    Takes { participant_label: {"messages": [...], "text": "transcript"} } and
+    submits the combined defense / KPI / summary call (and DSM-5, if available)
+    as separate tasks into one shared thread pool, so total wall time is
+    roughly the slowest single call instead of the sum of all of them.
 
-    # Identify the patient's name from the first thread's participant list
-    first_thread = next(iter(threads.values()))
-    patient_name = identify_patient(first_thread["participants"])
-    print(f"Patient identified as: {patient_name}\n")
+    Conversations with an identical transcript are analyzed once and the
+    result is copied to every label that shares it.
 
-    # Build the top-level results container
-    results = {
-        "patient_name": patient_name,
-        "conversations": {}
+    If given, on_result(label, conversation_result) is called from this thread
+    as soon as each conversation finishes, e.g. to persist progress.
+
+    refresh=True skips the response cache and re-runs every analysis
+    (the fresh responses replace the cached ones).
+
+    If cancel (a threading.Event) gets set, calls that haven't started yet are
+    dropped, and only the conversations already finished are returned.
+
+    Returns { participant_label: conversation_result } in the input order.
+    """
+    tasks = {"all": analyze_conversation_all}
+    if analyze_dsm5_diagnosis is not None:
+        tasks["dsm5"] = analyze_dsm5_diagnosis
+
+    # Group labels by transcript hash; the first label of each group is analyzed
+    duplicates = defaultdict(list)  # sha256 -> [participant labels]
+    digests = {}                    # participant label -> sha256
+    for label, conversation in conversations.items():
+        digest = hashlib.sha256(conversation["text"].encode("utf-8")).hexdigest()
+        duplicates[digest].append(label)
+        digests[label] = digest
+
+    collected = defaultdict(dict)   # representative label -> {kind: result}
+    errors = {}                     # representative label -> first error from a core analysis
+    finished = {}                   # participant label -> conversation result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Fan out: one future per (unique conversation, analysis kind).
+        # Longest transcripts go first so they aren't left running alone at the
+        # end; the short ones backfill the idle workers.
+        longest_first = sorted(
+            duplicates.values(), key=lambda labels: len(conversations[labels[0]]["text"]), reverse=True
+        )
+        futures = {}
+        for labels in longest_first:
+            label = labels[0]
+            for kind, fn in tasks.items():
+                future = executor.submit(fn, conversations[label]["text"], label, refresh=refresh)
+                futures[future] = (label, kind)
+
+        # Fan in: file each result as soon as it arrives
+        remaining = {labels[0]: len(tasks) for labels in duplicates.values()}
+        for future in as_completed(futures):
+            if cancel is not None and cancel.is_set():
+                # Nobody wants the results any more; let only the running calls finish
+                for pending in futures:
+                    pending.cancel()
+                break
+
+            label, kind = futures[future]
+            try:
+                collected[label][kind] = future.result()
+            except Exception as e:
+                if kind == "dsm5":
+                    # DSM-5 is optional — keep the rest of the conversation's results
+                    log(f"  ⚠ DSM-5 analysis failed for '{label}': {e}")
+                    collected[label][kind] = {"error": str(e)}
+                else:
+                    errors.setdefault(label, e)
+
+            remaining[label] -= 1
+            if remaining[label] == 0:
+                if label in errors:
+                    log(f"  ✗ Error analyzing '{label}': {errors[label]}")
+                else:
+                    log(f"  ✓ Done: {label}")
+
+                # Fan the finished result out to every label sharing this transcript
+                for shared_label in duplicates[digests[label]]:
+                    finished[shared_label] = conversation_result(
+                        conversations[shared_label], collected[label], errors.get(label),
+                        copy_data=shared_label != label
+                    )
+                    if on_result is not None:
+                        on_result(shared_label, finished[shared_label])
+
+    # Return the results in the original conversation order
+    return {label: finished[label] for label in conversations if label in finished}
+
+
+def conversation_result(conversation: dict, data: dict, error=None, copy_data: bool = False) -> dict:
+    """Shape one conversation's collected analyses (or its error) into the saved result format."""
+    if error is not None:
+        # If one conversation fails, record the error and keep the others
+        return {"error": str(error)}
+
+    if copy_data:
+        data = copy.deepcopy(data)  # duplicates get their own copy, not a shared dict
+    analysis = data["all"]
+    return {
+        "message_count":       len(conversation["messages"]),
+        "defense_mechanisms":  analysis["defense_mechanisms"],
+        "kpis":                analysis["kpis"],
+        "qualitative_summary": analysis["qualitative_summary"],
+        "dsm5_diagnosis":      data.get("dsm5")
     }
 
-    # Loop through every conversation thread and run analysis
+
+def prepare_conversations(threads: dict, patient_name: str) -> dict:
+    """
+    Parse every thread into a trimmed Claude transcript, skipping threads
+    where the patient wrote fewer than MIN_PATIENT_MESSAGES messages.
+
+    Returns { participant_label: {"messages": [...], "text": "transcript"} }
+    """
+    conversations = {}
     for thread_key, thread_data in threads.items():
 
         # Use the human-readable thread title if available, otherwise use folder name
@@ -413,55 +724,217 @@ def run_analysis(path: str) -> dict:
         # Parse raw Instagram messages into clean format
         messages = parse_thread(thread_data, patient_name)
 
-        # Skip threads where the patient sent no messages (read-only threads, etc.)
-        patient_messages = [m for m in messages if m["is_patient"]]
-        if not patient_messages:
-            print(f"Skipping '{participant_label}' (no patient messages found)")
+        # Skip threads where the patient barely wrote (read-only threads, one-off
+        # replies, etc.) before spending any Claude calls on them
+        patient_count = sum(1 for m in messages if m["is_patient"])
+        if patient_count < MIN_PATIENT_MESSAGES:
+            print(f"Skipping '{participant_label}' ({patient_count} patient message(s))")
             continue
 
-        print(f"Analyzing: {participant_label} ({len(messages)} total, {len(patient_messages)} from patient)")
+        print(f"Queued: {participant_label} ({len(messages)} total, {patient_count} from patient)")
 
         # Format the messages as a Claude-readable transcript and trim if too long
         conversation_text = format_for_claude(messages)
         conversation_text = trim_to_token_limit(conversation_text)
 
-        # Run all three Claude analyses and store the results
+        conversations[participant_label] = {"messages": messages, "text": conversation_text}
+
+    return conversations
+
+
+def load_and_prepare(path: str) -> tuple:
+    """Load an export, identify the patient, and prepare every conversation."""
+
+    # Load and merge all message files from the given path (file or folder)
+    print(f"\nLoading Instagram export from: {path}")
+    threads = load_instagram_export(path)
+    print(f"Found {len(threads)} conversation thread(s)\n")
+
+    # Identify the patient's name from the first thread's participant list
+    first_thread = next(iter(threads.values()))
+    patient_name = identify_patient(first_thread["participants"])
+    print(f"Patient identified as: {patient_name}\n")
+
+    return patient_name, prepare_conversations(threads, patient_name)
+
+
+def load_previous_results(output_path: str, patient_name: str) -> dict:
+    """
+    Return the conversations already analyzed successfully in an earlier
+    (possibly interrupted) run for the same patient, or {} if there is none.
+    """
+    if not os.path.exists(output_path):
+        return {}
+    try:
+        with open(output_path, "rb") as f:
+            previous = json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    if previous.get("patient_name") != patient_name:
+        return {}
+    return {
+        label: result
+        for label, result in previous.get("conversations", {}).items()
+        if "error" not in result
+    }
+
+
+def run_analysis(path: str, output_path: str = RESULTS_PATH) -> dict:
+    """
+    Full pipeline: load all files from the Instagram export path,
+    parse every conversation, run the combined Claude analysis on each,
+    and return the compiled results dict.
+
+    Results are written to output_path after every finished conversation,
+    and conversations already in that file are skipped, so an interrupted
+    run picks up where it stopped.
+    """
+    patient_name, conversations = load_and_prepare(path)
+
+    # Resume: keep earlier successful results, only analyze what's missing
+    done = load_previous_results(output_path, patient_name)
+    done = {label: result for label, result in done.items() if label in conversations}
+    pending = {label: conv for label, conv in conversations.items() if label not in done}
+    if done:
+        print(f"Resuming: {len(done)} conversation(s) already in {output_path}")
+
+    results = {"patient_name": patient_name, "conversations": done}
+
+    def checkpoint(label, conversation_result):
+        results["conversations"][label] = conversation_result
+        write_results(results, output_path)
+
+    # Run all Claude analyses for all pending conversations in parallel
+    print(f"\nAnalyzing {len(pending)} conversation(s)...")
+    analyze_conversations(pending, on_result=checkpoint)
+
+    # Put the conversations back in export order
+    results["conversations"] = {
+        label: results["conversations"][label] for label in conversations
+    }
+    return results
+
+
+def run_analysis_batched(path: str, poll_interval: int = BATCH_POLL_INTERVAL) -> dict:
+    """
+    Same pipeline as run_analysis, but submits the prompts for every
+    conversation as one Anthropic Message Batch. Batches are processed
+    asynchronously at half the per-token price, which suits offline
+    analysis of a whole export. Blocks until the batch has ended.
+    """
+    patient_name, conversations = load_and_prepare(path)
+    return {
+        "patient_name": patient_name,
+        "conversations": analyze_conversations_batched(conversations, poll_interval)
+    }
+
+
+def analyze_conversations_batched(conversations: dict, poll_interval: int = BATCH_POLL_INTERVAL) -> dict:
+    """
+    Message Batch counterpart of analyze_conversations: same input, and the
+    same { participant_label: conversation_result } output in input order.
+    """
+    if not conversations:
+        return {}
+
+    if DSM5_AVAILABLE:
+        from dsm5_diagnostic_ai import (
+            DSM5_CRITERIA, select_disorders, build_disorder_request,
+            parse_disorder_response, summarize_assessments,
+        )
+        disorder_names = list(DSM5_CRITERIA.keys())
+
+    # custom_id only allows [a-zA-Z0-9_-], so conversations are referenced by index
+    labels = list(conversations.keys())
+    requests = []
+    for index, label in enumerate(labels):
+        text = conversations[label]["text"]
+        requests.append({"custom_id": f"c{index}-all", "params": build_analysis_request(text, label)})
+
+        if DSM5_AVAILABLE:
+            for disorder_name in select_disorders(text):
+                disorder_index = disorder_names.index(disorder_name)
+                requests.append({
+                    "custom_id": f"c{index}-dsm5-{disorder_index}",
+                    "params": build_disorder_request(text, disorder_name, DSM5_CRITERIA[disorder_name])
+                })
+
+    # Submit the batch and wait for Anthropic to finish processing it
+    batch = _client().messages.batches.create(requests=requests)
+    print(f"\nSubmitted batch {batch.id} with {len(requests)} request(s)")
+    while batch.processing_status != "ended":
+        time.sleep(poll_interval)
+        batch = _client().messages.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        print(f"  Batch {batch.processing_status}: {counts.succeeded} succeeded, "
+              f"{counts.errored} errored, {counts.processing} processing")
+
+    # Stream the results and file each one under its conversation
+    collected = defaultdict(dict)    # label -> {kind: parsed result}
+    assessments = defaultdict(list)  # label -> [DSM-5 assessments]
+    failed_disorders = defaultdict(list)  # label -> [disorders whose DSM-5 request failed]
+    errors = {}                      # label -> first error from a core analysis
+    for entry in _client().messages.batches.results(batch.id):
+        parts = entry.custom_id.split("-")
+        label = labels[int(parts[0][1:])]
+        kind = parts[1]
+
         try:
-            defense_data = analyze_defense_mechanisms(conversation_text, participant_label)
-            kpi_data     = analyze_kpis(conversation_text, participant_label)
-            summary_data = qualitative_summary(conversation_text, participant_label)
-            
-            # Run DSM-5 diagnostic assessment if available
-            dsm5_data = None
-            if DSM5_AVAILABLE:
-                try:
-                    print(f"  Running DSM-5 diagnostic assessment...")
-                    dsm5_data = analyze_dsm5_diagnosis(conversation_text, participant_label)
-                except Exception as dsm_error:
-                    print(f"  ⚠ DSM-5 analysis failed: {dsm_error}")
-                    dsm5_data = {"error": str(dsm_error)}
-
-            results["conversations"][participant_label] = {
-                "message_count":       len(messages),
-                "defense_mechanisms":  defense_data,
-                "kpis":                kpi_data,
-                "qualitative_summary": summary_data,
-                "dsm5_diagnosis":      dsm5_data  # Add DSM-5 diagnosis
-            }
-            print(f"  ✓ Done\n")
+            if entry.result.type != "succeeded":
+                raise RuntimeError(f"Batch request {entry.result.type}")
+            message = entry.result.message
+
+            if kind == "dsm5":
+                disorder_name = disorder_names[int(parts[2])]
+                assessments[label].append(
+                    parse_disorder_response(message.content[0].text, disorder_name, DSM5_CRITERIA[disorder_name])
+                )
+            else:
+                collected[label][kind] = parse_analysis_response(message)
 
         except Exception as e:
-            # If one conversation fails, log the error and continue with the others
-            print(f"  ✗ Error analyzing '{participant_label}': {e}\n")
-            results["conversations"][participant_label] = {"error": str(e)}
+            if kind == "dsm5":
+                # Failed disorders are listed separately, same as the synchronous path
+                print(f"  ⚠ DSM-5 request {entry.custom_id} failed: {e}")
+                failed_disorders[label].append(disorder_names[int(parts[2])])
+            else:
+                errors.setdefault(label, e)
+
+    # Assemble the final results in the original conversation order
+    results = {}
+    for label in labels:
+        if label in errors:
+            print(f"  ✗ Error analyzing '{label}': {errors[label]}")
+        elif DSM5_AVAILABLE:
+            try:
+                collected[label]["dsm5"] = summarize_assessments(assessments[label], failed_disorders[label])
+            except RuntimeError as e:
+                print(f"  ⚠ DSM-5 analysis failed for '{label}': {e}")
+                collected[label]["dsm5"] = {"error": str(e)}
+        results[label] = conversation_result(conversations[label], collected[label], errors.get(label))
 
     return results
 
 
-def save_results(results: dict, output_path: str = "analysis_results.json"):
+def write_results(results: dict, output_path: str = RESULTS_PATH):
+    """
+    Atomically write the results JSON: dump to a temp file next to it, then
+    os.replace it over the old one, so a crash never leaves a half-written file.
+    """
+    if orjson is not None:
+        data = orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(results, indent=2, ensure_ascii=False).encode("utf-8")
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+
+
+def save_results(results: dict, output_path: str = RESULTS_PATH):
     """Save the full results dict to a JSON file for the dashboard to load."""
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+    write_results(results, output_path)
     print(f"Results saved to: {output_path}")
 
 
@@ -509,44 +982,24 @@ def run_demo() -> dict:
 
     # Identify patient from the first demo thread
     patient_name = identify_patient(demo_threads["alex_demo"]["participants"])
-    results = {"patient_name": patient_name, "conversations": {}}
 
-    # Run the full three-part analysis on each demo thread
+    # Parse and format each demo thread into a Claude-readable transcript
+    conversations = {}
     for thread_key, thread_data in demo_threads.items():
         participant_label = thread_data["title"]
-        print(f"Analyzing demo conversation with {participant_label}...")
+        print(f"Queued demo conversation with {participant_label}")
 
-        # Parse and format the demo messages into a Claude-readable transcript
         messages = parse_thread(thread_data, patient_name)
-        conversation_text = format_for_claude(messages)
-
-        try:
-            defense_data = analyze_defense_mechanisms(conversation_text, participant_label)
-            kpi_data     = analyze_kpis(conversation_text, participant_label)
-            summary_data = qualitative_summary(conversation_text, participant_label)
-            
-            # Run DSM-5 diagnostic assessment if available
-            dsm5_data = None
-            if DSM5_AVAILABLE:
-                try:
-                    dsm5_data = analyze_dsm5_diagnosis(conversation_text, participant_label)
-                except Exception as dsm_error:
-                    dsm5_data = {"error": str(dsm_error)}
-
-            results["conversations"][participant_label] = {
-                "message_count":       len(messages),
-                "defense_mechanisms":  defense_data,
-                "kpis":                kpi_data,
-                "qualitative_summary": summary_data,
-                "dsm5_diagnosis":      dsm5_data
-            }
-            print(f"  ✓ Done\n")
-
-        except Exception as e:
-            print(f"  ✗ Error: {e}\n")
-            results["conversations"][participant_label] = {"error": str(e)}
+        conversations[participant_label] = {
+            "messages": messages,
+            "text":     format_for_claude(messages)
+        }
 
-    return results
+    # Run the full analysis on every demo thread in parallel
+    return {
+        "patient_name": patient_name,
+        "conversations": analyze_conversations(conversations)
+    }
 
 
 # ════════════════════════════════════════════════════════════════
@@ -556,10 +1009,14 @@ def run_demo() -> dict:
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) > 1:
+    # --batch sends everything through the Message Batches API (cheaper, slower)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    use_batch = "--batch" in sys.argv[1:]
+
+    if args:
         # A path was passed as a command-line argument — can be a file OR folder
-        path = sys.argv[1]
-        results = run_analysis(path)
+        path = args[0]
+        results = run_analysis_batched(path) if use_batch else run_analysis(path)
     else:
         # No argument provided: fall back to demo mode
         results = run_demo()
@@ -0,0 +1,105 @@
+"""
+Helpers shared by analyzer.py and dsm5_diagnostic_ai.py: the Anthropic client
+and its retry/timeout settings, and token budgeting for transcripts.
+
+Kept in their own module so the DSM-5 module never has to import analyzer,
+which is also the command-line script: `python analyzer.py` runs it as
+__main__, and an `import analyzer` from inside would load and execute it a
+second time.
+"""
+
+import functools
+
+
+# ════════════════════════════════════════════════════════════════
+#  ANTHROPIC CLIENT
+# ════════════════════════════════════════════════════════════════
+
+# ── Retries for transient API errors, and per-request timeouts (seconds) ──
+API_MAX_RETRIES = 5
+API_CONNECT_TIMEOUT_SECONDS = 5
+
+# A non-streaming response only arrives once generation is finished, so the read
+# timeout has to outlast the longest one: max_tokens=4000 (the combined prompt)
+# at a slow ~10 tokens/s is 400 s. Anything shorter can expire mid-generation,
+# and each retry is billed again.
+API_TIMEOUT_SECONDS = 600
+
+
+@functools.lru_cache(maxsize=1)
+def anthropic_client():
+    """
+    Create the Anthropic client on first use (reads ANTHROPIC_API_KEY from environment).
+    The SDK import is deferred too, since it is the slowest part of importing the analyzer.
+
+    The SDK retries 408/409/429/5xx responses and connection errors itself, with
+    exponential backoff and jitter (honouring retry-after), so a rate limit or an
+    overloaded API doesn't fail the whole conversation.
+    """
+    import httpx
+    from anthropic import Anthropic
+    return Anthropic(
+        max_retries=API_MAX_RETRIES,
+        timeout=httpx.Timeout(API_TIMEOUT_SECONDS, connect=API_CONNECT_TIMEOUT_SECONDS)
+    )
+
+
+# ════════════════════════════════════════════════════════════════
+#  TOKEN BUDGETS
+# ════════════════════════════════════════════════════════════════
+
+@functools.lru_cache(maxsize=1)
+def _token_encoder():
+    """Load the BPE encoding once; None if tiktoken (or its data file) is unavailable."""
+    try:
+        import tiktoken  # optional; imported here so importing this module stays fast
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Token count for a piece of transcript. Uses a BPE tokenizer when available;
+    otherwise estimates ~4 characters per token, which is close for English chat.
+    """
+    encoder = _token_encoder()
+    if encoder is not None:
+        return len(encoder.encode_ordinary(text))
+    return len(text) // 4 + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """The start of text, cut so it fits in max_tokens (text itself if it already does)."""
+    encoder = _token_encoder()
+    if encoder is not None:
+        tokens = encoder.encode_ordinary(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoder.decode(tokens[:max_tokens])
+    if count_tokens(text) <= max_tokens:
+        return text
+    return text[:max(max_tokens - 1, 0) * 4]
+
+
+def keep_recent_lines(lines: list, max_tokens: int) -> list:
+    """
+    The most recent lines that fit in max_tokens, in their original order
+    (each newline between lines counts as one token).
+
+    The newest line is always kept: if it alone is over the budget it is cut
+    down to fit, so a transcript never comes back empty just because its last
+    message is long.
+    """
+    # Walk backwards from the newest line until the budget runs out
+    kept = 0
+    used = 0
+    for line in reversed(lines):
+        used += count_tokens(line) + 1  # +1 for the newline between messages
+        if used > max_tokens:
+            break
+        kept += 1
+
+    if kept == 0 and lines:
+        return [truncate_to_tokens(lines[-1], max(max_tokens - 1, 1))]
+    return lines[len(lines) - kept:]
@@ -4,8 +4,20 @@ Analyzes chat conversations against DSM-5 diagnostic criteria
 and provides evidence-based diagnosis recommendations.
 """
 
+import copy
 import re
-from typing import Dict, List, Tuple
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Tuple
+
+# ── pyahocorasick finds every indicator in one pass over the text; optional ──
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
 
 # ── DSM-5 Diagnostic Criteria Database ────────────────────────────────────────
 # This contains the major diagnostic criteria from DSM-5
@@ -1052,29 +1064,250 @@ DSM5_CRITERIA = {
 
 
 
+# ── Frozen catalog (built once at import) ───────────────────────────────────
+# The same data as DSM5_CRITERIA with every default resolved up front, so the
+# assessment loop reads slot attributes instead of doing dict .get() calls.
+
+@dataclass(frozen=True, slots=True)
+class Criterion:
+    id: str
+    text: str
+    indicators: Tuple[str, ...]
+
+
+@dataclass(frozen=True, slots=True)
+class Disorder:
+    name: str
+    dsm_page: int
+    pdf_page: int
+    section: str
+    required: int
+    duration: str
+    criteria: Tuple[Criterion, ...]
+
+    @classmethod
+    def from_dict(cls, name: str, info: Dict) -> "Disorder":
+        """Build from a DSM5_CRITERIA-style entry, applying the same defaults as before."""
+        criteria = tuple(
+            Criterion(criterion_id, data['text'], tuple(data['indicators']))
+            for criterion_id, data in info['criteria'].items()
+        )
+        return cls(
+            name=name,
+            dsm_page=info['dsm_page'],
+            pdf_page=info.get('pdf_page', info['dsm_page']),
+            section=info['section'],
+            required=info.get('criteria_count_required', len(criteria)),
+            duration=info.get('duration', 'Not specified'),
+            criteria=criteria
+        )
+
+
+DSM5_CATALOG = {name: Disorder.from_dict(name, info) for name, info in DSM5_CRITERIA.items()}
+
+
+# ── Indicator index (built once, on first scan) ──────────────────────────────
+# Every indicator, lowercased, maps to each place it appears in the catalog as
+# (disorder_name, criterion_id, position in that criterion's indicator list).
+# A few phrases are listed under more than one criterion, hence the lists.
+
+def build_indicator_index(criteria_db: Dict) -> Mapping[str, Tuple[Tuple[str, str, int], ...]]:
+    """
+    Map each lowercase indicator phrase to every (disorder, criterion, position) using it.
+    Read-only, so the cached DSM5_CRITERIA index can be handed to callers that
+    route a matched phrase straight to its criteria.
+    """
+    index = {}
+    for disorder_name, disorder_info in criteria_db.items():
+        for criterion_id, criterion_data in disorder_info['criteria'].items():
+            for position, indicator in enumerate(criterion_data['indicators']):
+                index.setdefault(indicator.lower(), []).append((disorder_name, criterion_id, position))
+    return MappingProxyType({phrase: tuple(entries) for phrase, entries in index.items()})
+
+
+def build_automaton(index: Dict):
+    """Compile all indicator phrases into one Aho-Corasick automaton."""
+    automaton = ahocorasick.Automaton()
+    for phrase in index:
+        automaton.add_word(phrase, phrase)
+    automaton.make_automaton()
+    return automaton
+
+
+@lru_cache(maxsize=1)
+def indicator_tables() -> Tuple[Mapping, object]:
+    """
+    (index, automaton) for DSM5_CRITERIA; automaton is None without pyahocorasick.
+    Built lazily because dsm5_diagnostic_ai imports this module only for the
+    criteria text and never scans, so it shouldn't pay to compile the automaton.
+    """
+    index = build_indicator_index(DSM5_CRITERIA)
+    automaton = build_automaton(index) if AHOCORASICK_AVAILABLE else None
+    return index, automaton
+
+# ── Confidence bands by % of criteria met: <40, 40-59, 60-79, 80+ ──
+CONFIDENCE_THRESHOLDS = (40, 60, 80)
+CONFIDENCE_LABELS = ("Very Low", "Low", "Moderate", "High")
+
+
+def at_word_boundary(text: str, start: int, end: int) -> bool:
+    """
+    True if text[start:end] isn't glued to letters or digits on either side
+    (the same idea as regex \\b), so "rage" doesn't match inside "storage".
+    """
+    if start > 0 and text[start].isalnum() and text[start - 1].isalnum():
+        return False
+    if end < len(text) and text[end - 1].isalnum() and text[end].isalnum():
+        return False
+    return True
+
+
+# ── NegEx-style negation: a trigger word negates the next few words of its clause ──
+NEGATION_TRIGGERS = ("no", "not", "never", "without", "denies", "non", "lack")
+NEGATION_WINDOW = 5  # words after the trigger that it can reach (NegEx's default)
+
+# ── Words that end a negation's scope: the next clause isn't negated ──
+# ("i'm not sleeping because i feel worthless" — the worthlessness stands)
+NEGATION_STOPS = (
+    "but", "however", "although", "though", "yet", "except",
+    "because", "since", "why", "that", "which", "who", "while",
+)
+
+# ── NegEx pseudo-triggers: phrases that contain a trigger word but negate nothing ──
+PSEUDO_NEGATIONS = (
+    "no one", "nobody", "nowhere", "no idea", "no reason", "not sure",
+    "no matter", "no doubt", "no wonder", "no joke", "no lie", "no cap",
+    "not only", "not just", "not even kidding", "not kidding", "not to mention",
+    "not gonna lie", "not going to lie", "never mind", "without a doubt",
+)
+
+
+def _phrase_pattern(phrases) -> str:
+    """Regex alternation of phrases, with any run of whitespace between their words."""
+    return "|".join(r"\s+".join(map(re.escape, phrase.split())) for phrase in phrases)
+
+
+# Matches a message prefix ending in a trigger plus up to NEGATION_WINDOW - 1 more
+# words, with no clause break (punctuation) or stop word in between. A trigger that begins a
+# pseudo-trigger ("no matter what i do") doesn't count.
+_NEGATED_PREFIX = re.compile(
+    r"\b(?!(?:" + _phrase_pattern(PSEUDO_NEGATIONS) + r")\b)"
+    r"(?:" + "|".join(NEGATION_TRIGGERS) + r")\b"
+    r"(?:\s+(?!(?:" + "|".join(NEGATION_STOPS) + r")\b)[^\s.,;:!?]+){0,%d}\s+$" % (NEGATION_WINDOW - 1)
+)
+
+# An indicator that is itself phrased as a negation ("no warning", "not on any drugs")
+_NEGATION_LEAD = re.compile(r"(?:" + "|".join(NEGATION_TRIGGERS) + r")\b")
+
+
+def is_evidence(text: str, message_start: int, start: int, end: int) -> bool:
+    """
+    Whether the indicator found at text[start:end] counts: it must stand as whole
+    words and not fall inside a negation that began earlier in its message.
+    Indicators that open with a trigger word are negations themselves, so an
+    earlier trigger ("i'm not drunk and not on any drugs") doesn't cancel them.
+    """
+    if not at_word_boundary(text, start, end):
+        return False
+    if _NEGATION_LEAD.match(text, start):
+        return True
+    return _NEGATED_PREFIX.search(text, message_start, start) is None
+
+
+def find_indicator_hits(patient_messages: List[str], criteria_db: Dict = None) -> Dict[Tuple[str, str], List[Tuple[int, int]]]:
+    """
+    Scan all patient messages for every indicator in a single pass.
+
+    Returns {(disorder_name, criterion_id): [(message_index, indicator_position), ...]}
+    with each list ordered by message, then by indicator — the same order a
+    message-by-message, indicator-by-indicator loop would find them in.
+    An indicator counts once per message, however often it occurs there, and
+    only where it stands as whole words ("tired" doesn't match "retired") and
+    isn't negated ("never felt like my heart was racing").
+
+    criteria_db defaults to DSM5_CRITERIA (using the cached index and automaton);
+    pass a different catalog to scan for its indicators instead.
+    """
+    if criteria_db is None:
+        index, automaton = indicator_tables()
+    else:
+        index, automaton = build_indicator_index(criteria_db), None
+
+    # Lowercase each message once and join them into one buffer. Indicators never
+    # contain a newline, so a match can't straddle two messages.
+    lowered = [message.lower() for message in patient_messages]
+    text = "\n".join(lowered)
+    starts = []  # offset of each message in the buffer
+    offset = 0
+    for message in lowered:
+        starts.append(offset)
+        offset += len(message) + 1
+
+    found = set()  # (phrase, message_index)
+    if automaton is not None:
+        for end, phrase in automaton.iter(text):
+            start = end - len(phrase) + 1
+            message_index = bisect_right(starts, start) - 1
+            if is_evidence(text, starts[message_index], start, end + 1):
+                found.add((phrase, message_index))
+    else:
+        # No automaton: one C-level substring search per distinct phrase, jumping
+        # to the next message after each counted hit
+        for phrase in index:
+            position = text.find(phrase)
+            while position != -1:
+                message_index = bisect_right(starts, position) - 1
+                if not is_evidence(text, starts[message_index], position, position + len(phrase)):
+                    position = text.find(phrase, position + 1)
+                    continue
+                found.add((phrase, message_index))
+                if message_index + 1 == len(starts):
+                    break
+                position = text.find(phrase, starts[message_index + 1])
+
+    hits = {}
+    for phrase, message_index in found:
+        for disorder_name, criterion_id, position in index[phrase]:
+            hits.setdefault((disorder_name, criterion_id), []).append((message_index, position))
+    for criterion_hits in hits.values():
+        criterion_hits.sort()
+    return hits
+
+
 def analyze_dsm5_diagnosis(conversation_text: str, participant_name: str) -> Dict:
-    """Analyze conversation against DSM-5 criteria and return diagnosis."""
+    """
+    Analyze conversation against DSM-5 criteria and return diagnosis.
+    Results for recently seen transcripts are reused (the caller gets its own copy).
+    """
+    return copy.deepcopy(_diagnose_transcript(conversation_text))
+
+
+@lru_cache(maxsize=128)
+def _diagnose_transcript(conversation_text: str) -> Dict:
+    """Uncached diagnosis of one transcript; only the patient's lines are assessed."""
     
-    messages = conversation_text.split('\n')
-    patient_messages = [m for m in messages if m.startswith('[PATIENT]:')]
+    # Keep only the patient's lines in a single pass; the scanner joins them
+    # into one lowercase buffer, so nothing else holds the whole transcript
+    patient_messages = [line for line in conversation_text.split('\n') if line.startswith('[PATIENT]:')]
+    
+    # One scan finds the evidence for every disorder at once
+    hits = find_indicator_hits(patient_messages)
     
     diagnoses_assessed = []
     
-    for disorder_name, disorder_info in DSM5_CRITERIA.items():
-        assessment = assess_disorder(
-            disorder_name,
-            disorder_info,
-            patient_messages
-        )
+    for disorder in DSM5_CATALOG.values():
+        assessment = _assess(disorder, patient_messages, hits)
         diagnoses_assessed.append(assessment)
     
-    diagnoses_assessed.sort(key=lambda x: x['criteria_met_percentage'], reverse=True)
+    # Primary diagnosis: highest percentage among those meeting threshold (first wins ties)
+    primary_diagnosis = max(
+        (d for d in diagnoses_assessed if d['meets_diagnostic_threshold']),
+        key=lambda x: x['criteria_met_percentage'],
+        default=None
+    )
     
-    primary_diagnosis = None
-    for diagnosis in diagnoses_assessed:
-        if diagnosis['meets_diagnostic_threshold']:
-            primary_diagnosis = diagnosis
-            break
+    # The dashboard lists all assessments in this order
+    diagnoses_assessed.sort(key=lambda x: x['criteria_met_percentage'], reverse=True)
     
     return {
         "primary_diagnosis": primary_diagnosis,
@@ -1083,59 +1316,71 @@ def analyze_dsm5_diagnosis(conversation_text: str, participant_name: str) -> Dic
     }
 
 
-def assess_disorder(disorder_name: str, disorder_info: Dict, patient_messages: List[str]) -> Dict:
-    """Assess specific disorder against conversation."""
+def assess_disorder(disorder_name: str, disorder_info: Dict, patient_messages: List[str], hits: Dict = None) -> Dict:
+    """
+    Assess specific disorder against conversation.
+    hits is the output of find_indicator_hits; it is computed for this disorder alone if omitted.
+    """
+    
+    if hits is None:
+        hits = find_indicator_hits(patient_messages, {disorder_name: disorder_info})
+    
+    disorder = DSM5_CATALOG.get(disorder_name)
+    if disorder is None or DSM5_CRITERIA[disorder_name] is not disorder_info:
+        disorder = Disorder.from_dict(disorder_name, disorder_info)
+    return _assess(disorder, patient_messages, hits)
+
+
+def _assess(disorder: Disorder, patient_messages: List[str], hits: Dict) -> Dict:
+    """assess_disorder over a frozen catalog entry."""
     
     criteria_results = {}
     criteria_met_count = 0
     evidence_collection = []
     
-    for criterion_id, criterion_data in disorder_info['criteria'].items():
-        evidence_found = []
+    for criterion in disorder.criteria:
+        criterion_id = criterion.id
+        indicators = criterion.indicators
+        criterion_hits = hits.get((disorder.name, criterion_id), ())
         
-        for message in patient_messages:
-            message_lower = message.lower()
-            
-            for indicator in criterion_data['indicators']:
-                if indicator.lower() in message_lower:
-                    evidence_found.append({
-                        "message": message.replace('[PATIENT]:', '').strip(),
-                        "indicator_matched": indicator,
-                        "criterion_id": criterion_id
-                    })
+        # Only the first 3 pieces of evidence are ever shown, so only those are
+        # built; the rest just count toward evidence_count
+        evidence_found = [
+            {
+                "message": patient_messages[message_index].replace('[PATIENT]:', '').strip(),
+                "indicator_matched": indicators[position],
+                "criterion_id": criterion_id
+            }
+            for message_index, position in criterion_hits[:3]
+        ]
         
-        is_met = len(evidence_found) > 0
+        is_met = len(criterion_hits) > 0
         
         criteria_results[criterion_id] = {
-            "criterion_text": criterion_data['text'],
+            "criterion_text": criterion.text,
             "is_met": is_met,
-            "evidence": evidence_found[:3],
-            "evidence_count": len(evidence_found)
+            "evidence": evidence_found,
+            "evidence_count": len(criterion_hits)
         }
         
         if is_met:
             criteria_met_count += 1
-            evidence_collection.extend(evidence_found[:2])
+            # key_evidence keeps the first 5, so stop collecting once it's full
+            if len(evidence_collection) < 5:
+                evidence_collection.extend(evidence_found[:2])
     
-    total_criteria = len(disorder_info['criteria'])
-    required_count = disorder_info.get('criteria_count_required', total_criteria)
+    total_criteria = len(disorder.criteria)
+    required_count = disorder.required
     meets_threshold = criteria_met_count >= required_count
     percentage = (criteria_met_count / total_criteria) * 100
     
-    if percentage >= 80:
-        confidence = "High"
-    elif percentage >= 60:
-        confidence = "Moderate"
-    elif percentage >= 40:
-        confidence = "Low"
-    else:
-        confidence = "Very Low"
+    confidence = CONFIDENCE_LABELS[bisect_right(CONFIDENCE_THRESHOLDS, percentage)]
     
     return {
-        "disorder_name": disorder_name,
-        "dsm5_page": disorder_info['dsm_page'],
-        "pdf_page": disorder_info.get('pdf_page', disorder_info['dsm_page']),
-        "section": disorder_info['section'],
+        "disorder_name": disorder.name,
+        "dsm5_page": disorder.dsm_page,
+        "pdf_page": disorder.pdf_page,
+        "section": disorder.section,
         "criteria_met": criteria_met_count,
         "total_criteria": total_criteria,
         "criteria_required": required_count,
@@ -1144,7 +1389,7 @@ def assess_disorder(disorder_name: str, disorder_info: Dict, patient_messages: L
         "confidence_level": confidence,
         "criteria_breakdown": criteria_results,
         "key_evidence": evidence_collection[:5],
-        "duration_note": disorder_info.get('duration', 'Not specified'),
+        "duration_note": disorder.duration,
         "clinical_interpretation": f"{'Meets' if meets_threshold else 'Does not meet'} diagnostic criteria ({criteria_met_count}/{required_count} criteria). {confidence} confidence."
     }
 
@@ -4,49 +4,95 @@ Uses Claude to intelligently match conversation content to DSM-5 criteria
 instead of simple keyword matching.
 """
 
-from anthropic import Anthropic
 import json
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from claude_utils import anthropic_client as _client, keep_recent_lines
+
+# Per-disorder progress is debug output; failures are warnings (printed to
+# stderr even when the app hasn't configured logging)
+log = logging.getLogger(__name__)
+
+# ── Per-disorder Claude calls are independent and I/O-bound; cap how many run at once ──
+# The cap is process-wide: every conversation's disorders share one pool, so
+# analyzing many conversations in parallel can't multiply it into a 429 storm
+MAX_DISORDER_WORKERS = 8
+
+# Created on first use; shared by every analyze_dsm5_with_ai call
+_disorder_pool = None
+_disorder_pool_lock = threading.Lock()
+
+
+def disorder_pool() -> ThreadPoolExecutor:
+    """The one thread pool that all per-disorder Claude calls run on."""
+    global _disorder_pool
+    with _disorder_pool_lock:
+        if _disorder_pool is None:
+            _disorder_pool = ThreadPoolExecutor(max_workers=MAX_DISORDER_WORKERS, thread_name_prefix="dsm5")
+        return _disorder_pool
+
+# ── Token budget for the transcript in each per-disorder prompt ──
+MAX_DSM5_TRANSCRIPT_TOKENS = 1500
 
-client = Anthropic()
 
 # Import the criteria database from the original module
 from dsm5_diagnostic import DSM5_CRITERIA
 
 
-def analyze_dsm5_with_ai(conversation_text: str, participant_name: str) -> dict:
+def format_criteria(disorder_info: dict) -> str:
+    """The criteria block of a disorder prompt: one "A1: text" entry per criterion."""
+    return "".join(
+        f"\n{crit_id}: {crit_data['text']}\n" for crit_id, crit_data in disorder_info['criteria'].items()
+    )
+
+
+# The criteria never change at runtime, so each disorder's block is built once
+CRITERIA_TEXT = {name: format_criteria(info) for name, info in DSM5_CRITERIA.items()}
+
+
+# ── Always sent to Claude; the rest only when a screening keyword appears ──
+PRIORITY_DISORDERS = frozenset({
+    "Separation Anxiety Disorder",
+    "Generalized Anxiety Disorder",
+    "Panic Disorder",
+    "Major Depressive Disorder",
+    "Social Anxiety Disorder"
+})
+
+# ── Anxiety/mood words that make the non-priority disorders worth checking ──
+SCREENING_KEYWORDS = ('scared', 'worried', 'anxious', 'panic', 'afraid', 'miss', 'sad', 'depressed')
+
+
+def select_disorders(conversation_text: str) -> list:
     """
-    Use Claude to intelligently analyze conversation against DSM-5 criteria.
-    This replaces keyword matching with AI understanding.
+    Pick which disorders are worth sending to Claude for this conversation.
+    Priority disorders are always checked; the rest only when the
+    conversation contains anxiety/mood keywords.
     """
     
-    # Get top 5 most relevant disorders to check (to save API calls)
-    priority_disorders = [
-        "Separation Anxiety Disorder",
-        "Generalized Anxiety Disorder", 
-        "Panic Disorder",
-        "Major Depressive Disorder",
-        "Social Anxiety Disorder"
-    ]
+    # The keyword check is the same for every non-priority disorder, so do it once
+    lower_text = conversation_text.lower()
+    has_keywords = any(word in lower_text for word in SCREENING_KEYWORDS)
     
-    all_assessments = []
+    return [
+        disorder_name for disorder_name in DSM5_CRITERIA
+        if has_keywords or disorder_name in PRIORITY_DISORDERS
+    ]
+
+
+def summarize_assessments(all_assessments: list, failed_disorders: list = ()) -> dict:
+    """
+    Rank per-disorder assessments and pick the primary diagnosis.
+    Disorders whose analysis failed are listed under "failed_disorders", so a
+    partial screening is never mistaken for a complete one (and isn't cached).
+    Raises RuntimeError if every disorder failed.
+    """
     
-    for disorder_name in DSM5_CRITERIA.keys():
-        # Prioritize likely disorders, skip others for efficiency
-        if disorder_name not in priority_disorders:
-            # Quick keyword check - if no anxiety/mood keywords, skip
-            if not any(word in conversation_text.lower() for word in ['scared', 'worried', 'anxious', 'panic', 'afraid', 'miss', 'sad', 'depressed']):
-                continue
-        
-        print(f"    Analyzing: {disorder_name}...")
-        assessment = analyze_disorder_with_ai(
-            conversation_text,
-            disorder_name,
-            DSM5_CRITERIA[disorder_name]
-        )
-        
-        if assessment:
-            all_assessments.append(assessment)
+    if failed_disorders and not all_assessments:
+        raise RuntimeError(f"DSM-5 analysis failed for all {len(failed_disorders)} disorders")
     
     # Sort by criteria met
     all_assessments.sort(key=lambda x: x['criteria_met_percentage'], reverse=True)
@@ -58,27 +104,74 @@ def analyze_dsm5_with_ai(conversation_text: str, participant_name: str) -> dict:
             primary = assessment
             break
     
-    return {
+    summary = {
         "primary_diagnosis": primary,
         "all_assessments": all_assessments,
         "disclaimer": "AI-assisted screening tool. Clinical diagnosis requires comprehensive evaluation by licensed professional."
     }
+    if failed_disorders:
+        summary["failed_disorders"] = list(failed_disorders)
+    return summary
 
 
-def analyze_disorder_with_ai(conversation_text: str, disorder_name: str, disorder_info: dict) -> dict:
+def analyze_dsm5_with_ai(conversation_text: str, participant_name: str) -> dict:
     """
-    Use Claude to determine if conversation matches DSM-5 criteria for a disorder.
+    Use Claude to intelligently analyze conversation against DSM-5 criteria.
+    This replaces keyword matching with AI understanding.
     """
     
-    # Build criteria text
-    criteria_text = ""
-    for crit_id, crit_data in disorder_info['criteria'].items():
-        criteria_text += f"\n{crit_id}: {crit_data['text']}\n"
+    disorder_names = select_disorders(conversation_text)
+    
+    def analyze(disorder_name):
+        log.debug("Analyzing: %s", disorder_name)
+        return analyze_disorder_with_ai(conversation_text, disorder_name, DSM5_CRITERIA[disorder_name])
+    
+    # Every disorder is its own round-trip, so send them concurrently on the
+    # shared pool; map keeps the selection order, which decides ties when the
+    # assessments are ranked
+    results = list(disorder_pool().map(analyze, disorder_names))
+    
+    all_assessments = [assessment for assessment in results if assessment]
+    failed_disorders = [name for name, assessment in zip(disorder_names, results) if not assessment]
+    
+    return summarize_assessments(all_assessments, failed_disorders)
+
+
+def trim_for_dsm5(conversation_text: str, max_tokens: int = MAX_DSM5_TRANSCRIPT_TOKENS) -> str:
+    """
+    Cut a transcript down for the per-disorder prompts. Only the patient's
+    lines are assessed, so keep those plus the line each one replies to,
+    then the most recent of them that fit in max_tokens, in their original
+    order. The newest line is always kept, cut down if it alone is too long.
+    """
+    lines = conversation_text.split("\n")
+    relevant = [
+        line for line, next_line in zip(lines, lines[1:] + [""])
+        if line.startswith("[PATIENT]") or next_line.startswith("[PATIENT]")
+    ]
     
-    prompt = f"""You are a clinical psychologist analyzing a conversation for signs of {disorder_name}.
+    return "\n".join(keep_recent_lines(relevant, max_tokens))
+
 
-CONVERSATION (Patient's messages marked with [PATIENT]):
-{conversation_text[:4000]}
+def build_disorder_request(conversation_text: str, disorder_name: str, disorder_info: dict) -> dict:
+    """
+    Build the Messages API parameters asking Claude whether the conversation
+    matches the DSM-5 criteria for one disorder.
+    The instructions and criteria are the same for every conversation checked
+    against this disorder, so they go in the system block; only the
+    transcript goes in the user message.
+    The system block is marked for prompt caching, but at roughly 700-850
+    tokens it is below Sonnet's 1024-token minimum, so nothing is cached yet.
+    """
+    
+    # Criteria text (precomputed for the built-in table; other dicts are formatted here)
+    if DSM5_CRITERIA.get(disorder_name) is disorder_info:
+        criteria_text = CRITERIA_TEXT[disorder_name]
+    else:
+        criteria_text = format_criteria(disorder_info)
+    
+    instructions = f"""You are a clinical psychologist analyzing a conversation for signs of {disorder_name}.
+The conversation is in the user message; the patient's messages are marked with [PATIENT].
 
 DSM-5 DIAGNOSTIC CRITERIA FOR {disorder_name}:
 {criteria_text}
@@ -105,67 +198,81 @@ TASK: Determine which criteria are met based on the conversation. Return ONLY va
 
 BE STRICT: Only mark criteria as met if there's clear evidence in the conversation."""
 
+    return {
+        "model": "claude-sonnet-4-5-20250929",
+        "max_tokens": 2000,
+        "system": [{"type": "text", "text": instructions, "cache_control": {"type": "ephemeral"}}],
+        "messages": [{
+            "role": "user",
+            "content": f"CONVERSATION (Patient's messages marked with [PATIENT]):\n{trim_for_dsm5(conversation_text)}"
+        }]
+    }
+
+
+def parse_disorder_response(raw: str, disorder_name: str, disorder_info: dict) -> dict:
+    """Convert Claude's raw JSON answer for one disorder into our assessment format."""
+    
+    # Clean JSON: keep the object itself, dropping any code fence or
+    # explanation Claude put around it
+    start, end = raw.find("{"), raw.rfind("}")
+    if start != -1 and end > start:
+        raw = raw[start:end + 1]
+    
+    result = json.loads(raw)
+    
+    # Build assessment in our format
+    criteria_breakdown = {}
+    evidence_collection = []
+    
+    for crit_id, crit_result in result['criteria_met'].items():
+        criteria_breakdown[crit_id] = {
+            "criterion_text": disorder_info['criteria'].get(crit_id, {}).get('text', ''),
+            "is_met": crit_result['is_met'],
+            "evidence": [{"message": crit_result['evidence'], "indicator_matched": "AI analysis", "criterion_id": crit_id}] if crit_result['evidence'] else [],
+            "evidence_count": 1 if crit_result['evidence'] else 0
+        }
+        
+        if crit_result['is_met'] and crit_result['evidence']:
+            evidence_collection.append({
+                "message": crit_result['evidence'],
+                "indicator_matched": "AI analysis",
+                "criterion_id": crit_id
+            })
+    
+    total_met = result['total_criteria_met']
+    required = disorder_info['criteria_count_required']
+    percentage = (total_met / len(disorder_info['criteria'])) * 100
+    
+    return {
+        "disorder_name": disorder_name,
+        "dsm5_page": disorder_info['dsm_page'],
+        "pdf_page": disorder_info.get('pdf_page', disorder_info['dsm_page']),
+        "section": disorder_info['section'],
+        "criteria_met": total_met,
+        "total_criteria": len(disorder_info['criteria']),
+        "criteria_required": required,
+        "criteria_met_percentage": round(percentage, 1),
+        "meets_diagnostic_threshold": result['meets_threshold'],
+        "confidence_level": result['confidence'],
+        "criteria_breakdown": criteria_breakdown,
+        "key_evidence": evidence_collection[:5],
+        "duration_note": disorder_info.get('duration', 'Not specified'),
+        "clinical_interpretation": result['clinical_notes']
+    }
+
+
+def analyze_disorder_with_ai(conversation_text: str, disorder_name: str, disorder_info: dict) -> dict:
+    """
+    Use Claude to determine if conversation matches DSM-5 criteria for a disorder.
+    """
     try:
-        response = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=2000,
-            messages=[{"role": "user", "content": prompt}]
+        response = _client().messages.create(
+            **build_disorder_request(conversation_text, disorder_name, disorder_info)
         )
-        
-        raw = response.content[0].text.strip()
-        
-        # Clean JSON
-        if raw.startswith("```json"):
-            raw = raw[7:]
-        if raw.startswith("```"):
-            raw = raw[3:]
-        if raw.endswith("```"):
-            raw = raw[:-3]
-        
-        result = json.loads(raw.strip())
-        
-        # Build assessment in our format
-        criteria_breakdown = {}
-        evidence_collection = []
-        
-        for crit_id, crit_result in result['criteria_met'].items():
-            criteria_breakdown[crit_id] = {
-                "criterion_text": disorder_info['criteria'].get(crit_id, {}).get('text', ''),
-                "is_met": crit_result['is_met'],
-                "evidence": [{"message": crit_result['evidence'], "indicator_matched": "AI analysis", "criterion_id": crit_id}] if crit_result['evidence'] else [],
-                "evidence_count": 1 if crit_result['evidence'] else 0
-            }
-            
-            if crit_result['is_met'] and crit_result['evidence']:
-                evidence_collection.append({
-                    "message": crit_result['evidence'],
-                    "indicator_matched": "AI analysis",
-                    "criterion_id": crit_id
-                })
-        
-        total_met = result['total_criteria_met']
-        required = disorder_info['criteria_count_required']
-        percentage = (total_met / len(disorder_info['criteria'])) * 100
-        
-        return {
-            "disorder_name": disorder_name,
-            "dsm5_page": disorder_info['dsm_page'],
-            "pdf_page": disorder_info.get('pdf_page', disorder_info['dsm_page']),
-            "section": disorder_info['section'],
-            "criteria_met": total_met,
-            "total_criteria": len(disorder_info['criteria']),
-            "criteria_required": required,
-            "criteria_met_percentage": round(percentage, 1),
-            "meets_diagnostic_threshold": result['meets_threshold'],
-            "confidence_level": result['confidence'],
-            "criteria_breakdown": criteria_breakdown,
-            "key_evidence": evidence_collection[:5],
-            "duration_note": disorder_info.get('duration', 'Not specified'),
-            "clinical_interpretation": result['clinical_notes']
-        }
+        return parse_disorder_response(response.content[0].text, disorder_name, disorder_info)
     
     except Exception as e:
-        print(f"      Error: {e}")
+        log.warning("DSM-5 analysis of %s failed: %s", disorder_name, e)
         return None
 
 
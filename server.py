@@ -10,36 +10,39 @@ Usage:
   4. Open browser to http://127.0.0.1:8000
 """
 
+import asyncio
+import functools
+import hashlib
 import json
 import os
 import tempfile
 import shutil
+import threading
+import time
+import uuid
 from typing import Optional
 from pathlib import Path
 
 # ── FastAPI imports for building the web server ────────────────────────────────
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 # ── Import all the analysis functions from our analyzer module ─────────────────
 from analyzer import (
     load_instagram_export,
+    json_loads,
     identify_patient,
     parse_thread,
     format_for_claude,
     trim_to_token_limit,
-    analyze_defense_mechanisms,
-    analyze_kpis,
-    qualitative_summary,
-    DSM5_AVAILABLE,
+    analyze_conversations,
+    analyze_conversations_batched,
+    MIN_PATIENT_MESSAGES,
 )
 
-# Import DSM-5 diagnostic function if available
-if DSM5_AVAILABLE:
-    from dsm5_diagnostic_ai import get_dsm5_diagnosis_ai as analyze_dsm5_diagnosis
-
 
 # ════════════════════════════════════════════════════════════════
 #  FASTAPI APP SETUP
@@ -53,14 +56,26 @@ app = FastAPI(
 )
 
 # ── CORS Middleware: allows the HTML dashboard to make API calls ───────────────
-# Without this, browsers block cross-origin requests for security
-# In production, you'd restrict allow_origins to specific domains
+# The dashboard served at / is same-origin and needs no CORS at all; these
+# origins cover opening it via localhost, while other sites can't call the API
+ALLOWED_ORIGINS = [
+    "http://127.0.0.1:8000",
+    "http://localhost:8000",
+]
+
+# Pages opened straight from disk (file://) send "Origin: null" — but so do
+# sandboxed iframes on any site, so that origin is only allowed on request:
+#   PSYCHOGRAPH_ALLOW_FILE_ORIGIN=1 python server.py
+if os.environ.get("PSYCHOGRAPH_ALLOW_FILE_ORIGIN") == "1":
+    ALLOWED_ORIGINS.append("null")
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],           # Allow all origins (fine for local dev)
-    allow_credentials=True,        # Allow cookies/auth headers
-    allow_methods=["*"],           # Allow all HTTP methods (GET, POST, etc.)
-    allow_headers=["*"],           # Allow all request headers
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=False,       # The API uses no cookies or auth headers
+    allow_methods=["GET", "POST"], # The only methods the API uses
+    allow_headers=["Content-Type"],
+    max_age=86400,                 # Browsers may cache a preflight for a day
 )
 
 
@@ -68,27 +83,49 @@ app.add_middleware(
 #  ROUTE 1: Serve the dashboard HTML at the root URL
 # ════════════════════════════════════════════════════════════════
 
+# ── The dashboard sits next to this script ──
+DASHBOARD_PATH = Path(__file__).parent / "dashboard.html"
+
+
+@functools.lru_cache(maxsize=1)
+def load_dashboard(mtime_ns: int) -> tuple:
+    """
+    Read dashboard.html and compute its ETag. Keyed on the file's
+    modification time, so it's read once per edit rather than per request.
+    """
+    html = DASHBOARD_PATH.read_bytes()
+    return html, f'"{hashlib.md5(html).hexdigest()}"'
+
+
 @app.get("/", response_class=HTMLResponse)
-def serve_dashboard():
+def serve_dashboard(request: Request):
     """
     When users visit http://127.0.0.1:8000/ in their browser,
     serve the dashboard HTML file directly.
     
     This eliminates the need to open the HTML file separately —
     everything runs through one URL.
-    """
-    dashboard_path = Path(__file__).parent / "dashboard.html"
     
+    The page carries an ETag, so a reload the browser already has
+    is answered with an empty 304 Not Modified.
+    """
     # Check if the dashboard file exists in the same folder as this script
-    if not dashboard_path.exists():
+    try:
+        mtime_ns = DASHBOARD_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
         raise HTTPException(
             status_code=500,
             detail=f"dashboard.html not found. Make sure it's in {Path(__file__).parent}"
         )
     
-    # Read and return the HTML content
-    with open(dashboard_path, "r", encoding="utf-8") as f:
-        return f.read()
+    html, etag = load_dashboard(mtime_ns)
+    
+    # no-cache still lets the browser keep the page; it just revalidates it
+    # each time, so edits to dashboard.html show up on the next reload
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
 
 
 # ════════════════════════════════════════════════════════════════
@@ -111,7 +148,7 @@ def health_check():
 # ════════════════════════════════════════════════════════════════
 
 @app.post("/analyze")
-async def analyze_instagram_export(file: UploadFile = File(...)):
+async def analyze_instagram_export(file: UploadFile = File(...), force: bool = False):
     """
     Main API endpoint that receives an Instagram export file (or folder),
     runs the full Claude analysis pipeline, and returns JSON results.
@@ -124,44 +161,20 @@ async def analyze_instagram_export(file: UploadFile = File(...)):
       
     Returns:
       JSON object matching the analysis_results.json format
-    """
-    
-    # ── Step 1: Validate the uploaded file ─────────────────────────────────────
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No file provided")
     
-    filename = file.filename.lower()
-    
-    # Accept either JSON or ZIP files
-    if not (filename.endswith(".json") or filename.endswith(".zip")):
-        raise HTTPException(
-            status_code=400,
-            detail="Please upload either a .json file or a .zip of your Instagram export"
-        )
-    
-    # ── Step 2: Read the uploaded file into memory ─────────────────────────────
-    try:
-        file_content = await file.read()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error reading file: {str(e)}")
+    Re-uploads are answered from the response caches; POST /analyze?force=1
+    re-runs every Claude analysis instead.
+    """
     
-    # ── Step 3: Handle the file based on its type ──────────────────────────────
     temp_dir = None
     try:
-        if filename.endswith(".json"):
-            # Single JSON file — parse it directly
-            data = handle_json_file(file_content, filename)
-            
-        elif filename.endswith(".zip"):
-            # ZIP archive — extract it to a temp folder and process
-            temp_dir = tempfile.mkdtemp()
-            data = handle_zip_file(file_content, temp_dir)
-        
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported file type")
+        # ── Steps 1-3: Validate the upload and unpack it ───────────────────────
+        data, temp_dir = await receive_upload(file)
         
         # ── Step 4: Run the full analysis pipeline ─────────────────────────────
-        results = run_full_analysis(data)
+        # It blocks on Claude for a while, so run it off the event loop to keep
+        # the server responsive to other requests in the meantime
+        results = await run_in_threadpool(run_full_analysis, data, force)
         
         return JSONResponse(content=results)
     
@@ -175,55 +188,254 @@ async def analyze_instagram_export(file: UploadFile = File(...)):
     
     finally:
         # ── Step 5: Clean up temporary files ───────────────────────────────────
-        # If we created a temp directory for ZIP extraction, delete it
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
+        remove_temp_dir(temp_dir)
+
+
+# ════════════════════════════════════════════════════════════════
+#  ROUTE 4: Streaming analysis endpoint
+# ════════════════════════════════════════════════════════════════
+
+@app.post("/analyze_stream")
+async def analyze_instagram_export_stream(file: UploadFile = File(...), force: bool = False):
+    """
+    Same input and analysis as /analyze, but the response is a stream of
+    server-sent events, so the dashboard can show progress on large exports:
+    
+      data: {"type": "conversation", "label": ..., "result": {...}}   (one per conversation, as it finishes)
+      data: {"type": "done", "results": {...}}                         (the full /analyze JSON)
+      data: {"type": "error", "detail": "..."}                         (instead of "done" on failure)
+    
+    Upload problems are still reported as a normal 400 before the stream starts.
+    """
+    data, temp_dir = await receive_upload(file)
+    
+    # Start the analysis here rather than on the body's first read, so the
+    # extracted export is cleaned up even if the stream is never consumed
+    events, cancel = start_stream_analysis(data, temp_dir, force)
+    return StreamingResponse(stream_events(events, cancel), media_type="text/event-stream")
+
+
+def start_stream_analysis(data: dict, temp_dir: Optional[str], force: bool):
+    """
+    Run run_full_analysis on a worker thread, posting its progress to an
+    asyncio queue. The worker deletes the extracted export when it's done.
+    Returns (events, cancel): setting cancel stops the analysis from starting
+    any more Claude calls.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    cancel = threading.Event()
+    
+    def emit(event):
+        try:
+            loop.call_soon_threadsafe(events.put_nowait, event)
+        except RuntimeError:
+            pass  # the event loop has shut down, so nobody is listening
+    
+    def emit_conversation(label, result):
+        emit({"type": "conversation", "label": label, "result": result})
+    
+    def work():
+        try:
+            results = run_full_analysis(data, force, on_result=emit_conversation, cancel=cancel)
+            emit({"type": "done", "results": results})
+        except HTTPException as e:
+            emit({"type": "error", "detail": e.detail})
+        except Exception as e:
+            emit({"type": "error", "detail": f"Analysis error: {str(e)}"})
+        finally:
+            remove_temp_dir(temp_dir)
+    
+    threading.Thread(target=work, daemon=True).start()
+    return events, cancel
+
+
+async def stream_events(events: asyncio.Queue, cancel: threading.Event):
+    """
+    Yield the analysis progress as server-sent events. If the client goes away,
+    Starlette cancels this generator, and cancel tells the worker to stop
+    instead of paying for results nobody will read.
+    """
+    try:
+        # "done" or "error" is always the last event
+        while True:
+            event = await events.get()
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if event["type"] != "conversation":
+                return
+    finally:
+        cancel.set()
+
+
+# ════════════════════════════════════════════════════════════════
+#  ROUTE 5: Message Batch analysis jobs
+# ════════════════════════════════════════════════════════════════
+
+# ── Jobs started by /analyze_batch, by id ──
+# Each is {"status": "processing" | "done" | "error"} plus "results" or "error",
+# and "finished_at" once it has ended. A finished job is forgotten as soon as
+# its outcome has been returned, or BATCH_JOB_TTL_SECONDS after it ended if
+# nobody asks, so the server doesn't hold every export's results forever.
+batch_jobs = {}
+batch_jobs_lock = threading.Lock()
+BATCH_JOB_TTL_SECONDS = 60 * 60
+
+
+def prune_batch_jobs():
+    """Drop finished jobs whose results were never collected within the TTL."""
+    cutoff = time.time() - BATCH_JOB_TTL_SECONDS
+    with batch_jobs_lock:
+        expired = [job_id for job_id, job in batch_jobs.items() if job.get("finished_at", cutoff) < cutoff]
+        for job_id in expired:
+            del batch_jobs[job_id]
+
+
+@app.post("/analyze_batch")
+async def analyze_instagram_export_batch(file: UploadFile = File(...)):
+    """
+    Same input as /analyze, but every Claude request goes into one Anthropic
+    Message Batch: half the price and no per-minute rate limits, at the cost
+    of taking minutes instead of seconds. Suits large exports.
+    
+    Returns {"job_id": ..., "status": "processing"} straight away; poll
+    GET /analyze_status/{job_id} until the status is "done" or "error".
+    """
+    data, temp_dir = await receive_upload(file)
+    
+    prune_batch_jobs()
+    job_id = uuid.uuid4().hex
+    with batch_jobs_lock:
+        batch_jobs[job_id] = {"status": "processing"}
+    
+    # The job outlives this request, so it runs on its own thread and
+    # deletes the extracted export itself when it finishes
+    threading.Thread(target=run_batch_job, args=(job_id, data, temp_dir), daemon=True).start()
+    
+    return {"job_id": job_id, "status": "processing"}
+
+
+@app.get("/analyze_status/{job_id}")
+def analyze_status(job_id: str):
+    """
+    Progress of a /analyze_batch job. Once "done", "results" holds the same
+    JSON that /analyze returns. A finished job is reported only once: after
+    that (or an hour after it ended) its id is unknown.
+    """
+    prune_batch_jobs()
+    with batch_jobs_lock:
+        job = batch_jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown job id")
+        if job["status"] != "processing":
+            del batch_jobs[job_id]
+    return {"job_id": job_id, **job}
+
+
+def run_batch_job(job_id: str, data: dict, temp_dir: Optional[str]):
+    """Run one /analyze_batch job to completion and record its outcome."""
+    try:
+        results = run_full_analysis(data, batched=True)
+        outcome = {"status": "done", "results": results}
+    except HTTPException as e:
+        outcome = {"status": "error", "error": e.detail}
+    except Exception as e:
+        outcome = {"status": "error", "error": f"Analysis error: {str(e)}"}
+    finally:
+        remove_temp_dir(temp_dir)
+    
+    outcome["finished_at"] = time.time()
+    with batch_jobs_lock:
+        batch_jobs[job_id] = outcome
 
 
 # ════════════════════════════════════════════════════════════════
 #  HELPER FUNCTIONS
 # ════════════════════════════════════════════════════════════════
 
+async def receive_upload(file: UploadFile) -> tuple:
+    """
+    Validate an uploaded export and unpack it into the data dict that
+    run_full_analysis takes. Returns (data, temp_dir): temp_dir holds an
+    extracted ZIP (None for JSON) and is the caller's to delete afterwards.
+    """
+    
+    # ── Step 1: Validate the uploaded file ─────────────────────────────────────
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+    
+    filename = file.filename.lower()
+    
+    # Accept either JSON or ZIP files
+    if not (filename.endswith(".json") or filename.endswith(".zip")):
+        raise HTTPException(
+            status_code=400,
+            detail="Please upload either a .json file or a .zip of your Instagram export"
+        )
+    
+    # ── Step 2: Read a JSON upload into memory ─────────────────────────────────
+    # ZIP uploads are not read here: FastAPI has already spooled them to a
+    # temporary file (on disk once large), and zipfile reads straight from it
+    if filename.endswith(".json"):
+        try:
+            file_content = await file.read()
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error reading file: {str(e)}")
+        
+        # Single JSON file — parse it directly
+        return handle_json_file(file_content, filename), None
+    
+    # ── Step 3: ZIP archive — extract it to a temp folder ──────────────────────
+    temp_dir = tempfile.mkdtemp()
+    try:
+        return await run_in_threadpool(handle_zip_file, file.file, temp_dir), temp_dir
+    except BaseException:
+        remove_temp_dir(temp_dir)
+        raise
+
+
+def remove_temp_dir(temp_dir: Optional[str]):
+    """Delete the temp directory a ZIP upload was extracted to, if there is one."""
+    if temp_dir and os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
 def handle_json_file(file_content: bytes, filename: str) -> dict:
     """
     Parse a single Instagram message JSON file.
     Handles both UTF-8 and Latin-1 encodings.
     """
-    # Try UTF-8 first (most common)
+    # UTF-8 first (most common); the raw bytes go straight to the parser,
+    # which is orjson when installed
     try:
-        text = file_content.decode("utf-8")
-        data = json.loads(text)
-        return {"single_file": data, "filename": filename}
-    
-    except UnicodeDecodeError:
-        # Fall back to Latin-1 if UTF-8 fails (Instagram sometimes uses this)
+        data = json_loads(file_content)
+    except ValueError as e:
         try:
-            text = file_content.decode("latin-1")
-            data = json.loads(text)
-            return {"single_file": data, "filename": filename}
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid JSON encoding: {str(e)}")
+            file_content.decode("utf-8")
+        except UnicodeDecodeError:
+            # Fall back to Latin-1 if UTF-8 fails (Instagram sometimes uses this)
+            try:
+                data = json_loads(file_content.decode("latin-1"))
+            except Exception as latin_error:
+                raise HTTPException(status_code=400, detail=f"Invalid JSON encoding: {str(latin_error)}")
+        else:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON format: {str(e)}")
     
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=400, detail=f"Invalid JSON format: {str(e)}")
+    return {"single_file": data, "filename": filename}
 
 
-def handle_zip_file(file_content: bytes, temp_dir: str) -> dict:
+def handle_zip_file(zip_file, temp_dir: str) -> dict:
     """
     Extract a ZIP file to a temporary directory and scan for Instagram
     message files. Returns a dict that can be passed to the analyzer.
+    
+    zip_file is the uploaded file object (or a path); it is read in place
+    rather than copied to disk first.
     """
     import zipfile
     
-    zip_path = os.path.join(temp_dir, "upload.zip")
-    
-    # Write the uploaded ZIP to disk temporarily
-    with open(zip_path, "wb") as f:
-        f.write(file_content)
-    
     # Extract all files from the ZIP
     try:
-        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
             zip_ref.extractall(temp_dir)
     except zipfile.BadZipFile:
         raise HTTPException(status_code=400, detail="Invalid ZIP file")
@@ -232,11 +444,18 @@ def handle_zip_file(file_content: bytes, temp_dir: str) -> dict:
     return {"folder": temp_dir}
 
 
-def run_full_analysis(data: dict) -> dict:
+def run_full_analysis(data: dict, force: bool = False, batched: bool = False, on_result=None,
+                      cancel: Optional[threading.Event] = None) -> dict:
     """
     Main analysis orchestrator. Takes either a single JSON file
     or a folder path, runs the full Claude analysis pipeline,
     and returns the results in dashboard format.
+    force=True bypasses the cached Claude responses; batched=True sends
+    every request through one Message Batch instead (blocks until it ends).
+    If given, on_result(label, result) is called with each conversation's
+    dashboard-format result as soon as it finishes (not in batched mode).
+    Once cancel is set, no further Claude calls are started and only the
+    conversations already finished are returned.
     """
     
     # ── Case 1: Single JSON file uploaded ──────────────────────────────────────
@@ -275,13 +494,8 @@ def run_full_analysis(data: dict) -> dict:
     first_thread = next(iter(threads.values()))
     patient_name = identify_patient(first_thread.get("participants", []))
     
-    # ── Build results container ────────────────────────────────────────────────
-    results = {
-        "patient_name": patient_name,
-        "conversations": {}
-    }
-    
-    # ── Loop through each conversation thread and analyze it ───────────────────
+    # ── Prepare every conversation before any Claude call is made ─────────────
+    conversations = {}
     for thread_key, thread_data in threads.items():
         
         # Extract the other person's name from participants list
@@ -298,86 +512,96 @@ def run_full_analysis(data: dict) -> dict:
         # Parse the raw messages into clean format
         messages = parse_thread(thread_data, patient_name)
         
-        # Skip threads where patient sent no messages
-        patient_messages = [m for m in messages if m.get("is_patient", False)]
-        if not patient_messages:
+        # Skip threads where the patient barely wrote; a couple of messages
+        # isn't enough to assess, so don't spend Claude calls on them
+        patient_count = sum(1 for m in messages if m.get("is_patient", False))
+        if patient_count < MIN_PATIENT_MESSAGES:
             continue
         
         # Format the conversation for Claude and trim if too long
         conversation_text = format_for_claude(messages)
         conversation_text = trim_to_token_limit(conversation_text)
         
-        # ── Run all three Claude analyses ──────────────────────────────────────
-        try:
-            defense_data = analyze_defense_mechanisms(conversation_text, participant_label)
-            kpi_data     = analyze_kpis(conversation_text, participant_label)
-            summary_data = qualitative_summary(conversation_text, participant_label)
-            
-            # ── Run DSM-5 diagnostic analysis if available ─────────────────────────
-            dsm5_data = None
-            if DSM5_AVAILABLE:
-                try:
-                    dsm5_data = analyze_dsm5_diagnosis(
-                        conversation_text, 
-                        participant_label
-                    )
-                except Exception as dsm_error:
-                    print(f"DSM-5 analysis failed for {participant_label}: {dsm_error}")
-                    dsm5_data = {"error": str(dsm_error)}
-            
-            # COMPATIBILITY LAYER: Convert new two-sided format to old one-sided format
-            # This allows the current dashboard to still work while we update it
-            old_format_defense = {
-                "defense_mechanisms": defense_data.get("patient_defense_mechanisms", {}),
-                "total_defense_events": defense_data.get("patient_total", 0),
-                "dominant_mechanism": defense_data.get("patient_dominant", "none")
-            }
-            
-            old_format_kpi = {
-                "kpis": kpi_data.get("patient_kpis", {}),
-                "overall_health_score": kpi_data.get("patient_overall_score", 0),
-                "flag_for_review": kpi_data.get("flag_for_review", False),
-                "flag_reason": kpi_data.get("flag_reason", None)
-            }
-            
-            old_format_summary = {
-                "relationship_dynamic": summary_data.get("relationship_dynamic", ""),
-                "behavioral_patterns": summary_data.get("patient_patterns", []),
-                "red_flags": summary_data.get("patient_red_flags", []),
-                "strengths": summary_data.get("patient_strengths", []),
-                "therapy_suggestions": summary_data.get("therapy_suggestions", []),
-                "clinical_notes": summary_data.get("clinical_notes", "")
-            }
-            
-            # Store the results for this conversation
-            results["conversations"][participant_label] = {
-                "message_count":       len(messages),
-                "defense_mechanisms":  old_format_defense,  # Old format for dashboard
-                "kpis":                old_format_kpi,      # Old format for dashboard
-                "qualitative_summary": old_format_summary,  # Old format for dashboard
-                # Also save the new two-sided data for future dashboard update
-                "_both_sides": {
-                    "defense": defense_data,
-                    "kpis": kpi_data,
-                    "summary": summary_data
-                },
-                # Add DSM-5 diagnostic assessment
-                "dsm5_diagnosis": dsm5_data if dsm5_data else {
-                    "primary_diagnosis": {
-                        "disorder": "DSM-5 Analysis Not Available",
-                        "confidence": "Insufficient Evidence",
-                        "clinical_notes": "DSM-5 diagnostic module not loaded"
-                    }
-                }
-            }
+        conversations[participant_label] = {"messages": messages, "text": conversation_text}
+    
+    # ── Run the combined and DSM-5 analyses for all conversations at once ─────
+    # analyze_conversations fans every call out over one thread pool, so the
+    # upload takes about as long as its slowest conversation, not the sum
+    if batched:
+        analyzed = analyze_conversations_batched(conversations)
+    else:
+        def report_dashboard_result(label, analysis):
+            on_result(label, dashboard_result(analysis))
         
-        except Exception as e:
-            # If one conversation fails, store the error but continue with others
-            results["conversations"][participant_label] = {
-                "error": str(e)
-            }
+        report = report_dashboard_result if on_result is not None else None
+        analyzed = analyze_conversations(conversations, refresh=force, on_result=report, cancel=cancel)
+    
+    return {
+        "patient_name": patient_name,
+        "conversations": {
+            label: dashboard_result(analysis) for label, analysis in analyzed.items()
+        }
+    }
+
+
+def dashboard_result(analysis: dict) -> dict:
+    """
+    Convert one conversation from analyze_conversations into the format the
+    dashboard reads, keeping the full two-sided data alongside it.
+    """
+    # If one conversation fails, store the error but continue with others
+    if "error" in analysis:
+        return {"error": analysis["error"]}
     
-    return results
+    defense_data = analysis["defense_mechanisms"]
+    kpi_data     = analysis["kpis"]
+    summary_data = analysis["qualitative_summary"]
+    dsm5_data    = analysis["dsm5_diagnosis"]  # None without the DSM-5 module, {"error": ...} if it failed
+    
+    # COMPATIBILITY LAYER: Convert new two-sided format to old one-sided format
+    # This allows the current dashboard to still work while we update it
+    old_format_defense = {
+        "defense_mechanisms": defense_data.get("patient_defense_mechanisms", {}),
+        "total_defense_events": defense_data.get("patient_total", 0),
+        "dominant_mechanism": defense_data.get("patient_dominant", "none")
+    }
+    
+    old_format_kpi = {
+        "kpis": kpi_data.get("patient_kpis", {}),
+        "overall_health_score": kpi_data.get("patient_overall_score", 0),
+        "flag_for_review": kpi_data.get("flag_for_review", False),
+        "flag_reason": kpi_data.get("flag_reason", None)
+    }
+    
+    old_format_summary = {
+        "relationship_dynamic": summary_data.get("relationship_dynamic", ""),
+        "behavioral_patterns": summary_data.get("patient_patterns", []),
+        "red_flags": summary_data.get("patient_red_flags", []),
+        "strengths": summary_data.get("patient_strengths", []),
+        "therapy_suggestions": summary_data.get("therapy_suggestions", []),
+        "clinical_notes": summary_data.get("clinical_notes", "")
+    }
+    
+    return {
+        "message_count":       analysis["message_count"],
+        "defense_mechanisms":  old_format_defense,  # Old format for dashboard
+        "kpis":                old_format_kpi,      # Old format for dashboard
+        "qualitative_summary": old_format_summary,  # Old format for dashboard
+        # Also save the new two-sided data for future dashboard update
+        "_both_sides": {
+            "defense": defense_data,
+            "kpis": kpi_data,
+            "summary": summary_data
+        },
+        # Add DSM-5 diagnostic assessment
+        "dsm5_diagnosis": dsm5_data if dsm5_data else {
+            "primary_diagnosis": {
+                "disorder": "DSM-5 Analysis Not Available",
+                "confidence": "Insufficient Evidence",
+                "clinical_notes": "DSM-5 diagnostic module not loaded"
+            }
+        }
+    }
 
 
 # ════════════════════════════════════════════════════════════════
@@ -0,0 +1,104 @@
+"""
+Tests for the keyword matcher's evidence rules in dsm5_diagnostic: whole-word
+matching and NegEx-style negation (triggers, pseudo-triggers, scope stops).
+
+Run from the repository root:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+
+from dsm5_diagnostic import DSM5_CRITERIA, at_word_boundary, find_indicator_hits
+
+WORTHLESS = ("Persistent Depressive Disorder (Dysthymia)", "B4")  # indicator "i'm worthless"
+HEART_RACING = ("Panic Disorder", "A1")                             # indicator "heart was racing"
+
+
+def criteria_hit(message: str) -> set:
+    """
+    (disorder, criterion) pairs found in one message, checked against both
+    scanners: the default one (the automaton, when pyahocorasick is installed)
+    and the plain substring scan used for a caller-supplied catalog.
+    """
+    default = set(find_indicator_hits([message]))
+    fallback = set(find_indicator_hits([message], DSM5_CRITERIA))
+    assert default == fallback, (message, default, fallback)
+    return default
+
+
+class WordBoundaryTests(unittest.TestCase):
+
+    def test_whole_word(self):
+        text = "i feel tired"
+        self.assertTrue(at_word_boundary(text, 7, 12))
+
+    def test_inside_a_longer_word(self):
+        text = "i'm retired"
+        self.assertFalse(at_word_boundary(text, 6, 11))   # "tired" in "retired"
+        self.assertFalse(at_word_boundary("storage", 2, 6))  # "rage" in "storage"
+
+    def test_prefix_of_a_longer_word(self):
+        self.assertFalse(at_word_boundary("worthlessness", 0, 9))
+
+    def test_punctuation_is_a_boundary(self):
+        self.assertTrue(at_word_boundary("so tired.", 3, 8))
+
+    def test_indicator_inside_a_word_is_not_evidence(self):
+        self.assertNotIn(WORTHLESS, criteria_hit("i'm worthlessness personified"))
+
+
+class NegationTests(unittest.TestCase):
+
+    def test_plain_hits(self):
+        self.assertIn(WORTHLESS, criteria_hit("i'm worthless"))
+        self.assertIn(HEART_RACING, criteria_hit("my heart was racing all night"))
+
+    def test_negated_hits_are_dropped(self):
+        self.assertNotIn(WORTHLESS, criteria_hit("i am not saying i'm worthless"))
+        self.assertNotIn(HEART_RACING, criteria_hit("never felt like my heart was racing"))
+
+    def test_negation_reaches_only_a_few_words(self):
+        self.assertIn(WORTHLESS, criteria_hit("not once in the last few weeks have i stopped thinking i'm worthless"))
+
+    def test_clause_break_ends_the_negation(self):
+        self.assertIn(WORTHLESS, criteria_hit("no, i'm worthless"))
+        self.assertIn(WORTHLESS, criteria_hit("i can't sleep. i'm worthless"))
+
+    def test_stop_words_end_the_negation(self):
+        for message in (
+            "i'm not sleeping because i'm worthless",
+            "not that i'm worthless",
+            "nothing helps but i'm worthless",
+            "i don't know why i'm worthless",
+        ):
+            with self.subTest(message=message):
+                self.assertIn(WORTHLESS, criteria_hit(message))
+
+    def test_pseudo_negations_are_not_negations(self):
+        for message in (
+            "no matter what i do i'm worthless",
+            "not gonna lie i'm worthless",
+            "no one knows i'm worthless",
+            "not sure i'm worthless",
+            "i have no idea if i'm worthless",
+            "not only do i hate it i'm worthless",
+            "no doubt i'm worthless",
+        ):
+            with self.subTest(message=message):
+                self.assertIn(WORTHLESS, criteria_hit(message))
+
+    def test_pseudo_negation_phrases_in_indicators(self):
+        self.assertTrue(criteria_hit("no one knows it happened for no reason"))
+        self.assertTrue(criteria_hit("not sure why, it came out of nowhere"))
+
+    def test_negation_stays_within_its_message(self):
+        hits = find_indicator_hits(["i'm not", "i'm worthless"])
+        self.assertEqual([message_index for message_index, _ in hits.get(WORTHLESS, [])], [1])
+
+    def test_self_negated_indicators_are_not_cancelled(self):
+        # "not on any drugs" is itself a negation; the earlier "not" mustn't undo it
+        self.assertTrue(criteria_hit("i'm not drunk and not on any drugs"))
+
+
+if __name__ == "__main__":
+    unittest.main()